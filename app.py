@@ -1,5 +1,6 @@
 import streamlit as st
 from streamlit_gsheets import GSheetsConnection
+from gspread.utils import rowcol_to_a1
 import streamlit.components.v1 as components
 import pandas as pd
 import plotly.express as px
@@ -8,6 +9,16 @@ import time
 from datetime import date, timedelta, datetime
 import math
 import numpy as np
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+import json
+import uuid
+import tempfile
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
 
 # ------------------------------------------------------------------
 # 1. PAGE CONFIGURATION
@@ -242,8 +253,8 @@ if "logged_in" not in st.session_state:
     st.session_state["logged_in"] = False
     st.session_state["user"] = None
     st.session_state["role"] = None
-if "edit_idx" not in st.session_state:
-    st.session_state["edit_idx"] = None 
+if "edit_row" not in st.session_state:
+    st.session_state["edit_row"] = None 
 
 if st.session_state["logged_in"] and st.session_state["user"] in USERS:
     st.session_state["access"] = USERS[st.session_state["user"]]["access"]
@@ -265,6 +276,9 @@ def login():
                 st.session_state["user"] = username
                 st.session_state["role"] = USERS[username]["role"]
                 st.session_state["access"] = USERS[username]["access"]
+                # The role's sheets load while the app shell renders; each module waits only for its own
+                warm_up(USERS[username]["access"])
+                st.session_state["sheets_loaded"] = True
                 st.rerun()
             else:
                 st.error("❌ Invalid ID or Password")
@@ -272,18 +286,673 @@ def login():
 def logout():
     st.session_state["logged_in"] = False
     st.session_state["user"] = None
-    st.session_state["edit_idx"] = None
+    st.session_state.pop("sheets_loaded", None)
+    st.session_state["edit_row"] = None
     st.rerun()
 
 # ------------------------------------------------------------------
-# 6. CONNECTION & HELPERS
+# 5.1 INSTRUMENTATION (TIMING SPANS PER RERUN)
 # ------------------------------------------------------------------
+PERF_HISTORY = 500  # Reruns kept for the p50/p95 panel, across all sessions
+
+@st.cache_resource
+def _perf_state():
+    # Process-wide, so engine objects cached by an earlier rerun still report into the current one
+    return {"runs": {}, "history": deque(maxlen=PERF_HISTORY), "log": False, "lock": threading.Lock()}
+
+def _session_id():
+    ctx = get_script_run_ctx(suppress_warning=True)
+    return ctx.session_id if ctx else None
+
+def perf_begin():
+    _perf_state()["runs"][_session_id()] = {"start": time.perf_counter(), "spans": []}
+
+def perf_end(module, fragment=None):
+    """Closes the rerun: keeps it for the timing panel and, when enabled, appends it to the JSON-lines log"""
+    state = _perf_state()
+    run = state["runs"].pop(_session_id(), None)
+    if run is None: return
+    entry = {"at": datetime.now().isoformat(timespec="seconds"), "user": st.session_state.get("user"), "module": module,
+             "fragment": fragment, "ms": round((time.perf_counter() - run["start"]) * 1000, 1), "spans": run["spans"]}
+    state["history"].append(entry)
+    st.session_state["perf_last"] = entry
+    if state["log"]:
+        with state["lock"], open(STORAGE.get("perf_log", "amavik_perf.jsonl"), "a") as f: f.write(json.dumps(entry, default=str) + "\n")
+
+@contextmanager
+def span(name, worksheet=None):
+    """Times the enclosed block as one span of the current rerun; work outside a rerun is not recorded"""
+    entry, start = {"name": name, "worksheet": worksheet, "bytes": 0}, time.perf_counter()
+    try: yield entry
+    finally:
+        entry["ms"] = round((time.perf_counter() - start) * 1000, 1)
+        run = _perf_state()["runs"].get(_session_id())
+        if run is not None: run["spans"].append(entry)
+
+def perf_fragment(fn):
+    """st.fragment whose own reruns (paging, search, forms) are recorded like full reruns"""
+    @wraps(fn)
+    def body(*args, **kwargs):
+        ctx, runs = get_script_run_ctx(suppress_warning=True), _perf_state()["runs"]
+        # Part of a full rerun, or nested in a fragment whose rerun is already open: its spans belong to that run
+        if not (ctx and ctx.fragment_ids_this_run) or _session_id() in runs: return fn(*args, **kwargs)
+        perf_begin()
+        run = runs[_session_id()]
+        try: return fn(*args, **kwargs)
+        finally:
+            if runs.get(_session_id()) is run: perf_end(st.session_state.get("active_module"), fn.__name__)
+    return st.fragment(body)
+
+def timed(fn):
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        with span(fn.__name__): return fn(*args, **kwargs)
+    return wrapper
+
+def perf_percentiles(history):
+    """p50 / p95 per span name, and for whole reruns and fragment reruns, over the kept history"""
+    runs = [(f"fragment {r['fragment']}" if r.get("fragment") else "rerun", r["ms"]) for r in history]
+    rows = runs + [(sp["name"], sp["ms"]) for r in history for sp in r["spans"]]
+    if not rows: return pd.DataFrame(columns=["Span", "Calls", "p50 ms", "p95 ms"])
+    ms = pd.DataFrame(rows, columns=["Span", "ms"]).groupby("Span")["ms"]
+    stats = pd.DataFrame({"Calls": ms.size(), "p50 ms": ms.quantile(0.5), "p95 ms": ms.quantile(0.95)}).round(1)
+    return stats.sort_values("p95 ms", ascending=False).reset_index()
+
+def _frame_bytes(value):
+    if isinstance(value, pd.DataFrame): return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, (dict, tuple, list)): return sum(_frame_bytes(v) for v in (value.values() if isinstance(value, dict) else value))
+    return 0
+
+def storage_call(fn):
+    """Times an engine call and counts it against its worksheet, with the in-memory size of the frames it moved"""
+    @wraps(fn)
+    def wrapper(self, worksheet_name, *args, **kwargs):
+        with span(f"{self.name}.{fn.__name__}", worksheet_name) as entry:
+            result = fn(self, worksheet_name, *args, **kwargs)
+            entry["bytes"] = _frame_bytes(result) + _frame_bytes(args)
+            return result
+    return wrapper
+
+perf_begin()
+
+# ------------------------------------------------------------------
+# 6. CONNECTION & STORAGE ENGINES
+# ------------------------------------------------------------------
+def _storage_settings():
+    try: return dict(st.secrets.get("storage", {}))
+    except Exception: return {}
+
+STORAGE = _storage_settings()  # [storage] engine = "gsheets" | "sqlite", path = "amavik.db"
+STORAGE_ENGINE = STORAGE.get("engine", "gsheets")
+WORKSHEETS = ["Order", "Production", "Packing", "Store", "Ecommerce"]
+ARCHIVE_SEP = " Archive "  # Monthly archive partitions are named e.g. "Store Archive 2026-01"
+
+def _q(name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+def _sql_value(val):
+    val = _cell_value(val)
+    return None if val == "" else val
+
+def own_write(fn):
+    """Records when a write from this process ran, so the modified time it leaves is not taken for an edit elsewhere"""
+    @wraps(fn)
+    def wrapper(self, *args, **kwargs):
+        start = time.time()
+        try: return fn(self, *args, **kwargs)
+        finally: self.own_writes.append((start, time.time()))
+    return wrapper
+
+class GSheetsStorage:
+    """Google Sheets engine: full-sheet reads, row-level writes through gspread"""
+    name = "gsheets"
+    STAMP_SKEW = 2  # Seconds of clock difference allowed between this server and Google
+
+    def __init__(self, connection):
+        self.conn, self.book, self.titles, self.sheets = connection, None, None, {}
+        self.own_writes = deque(maxlen=64)  # (start, end) of recent writes from this process
+
+    def _book(self):
+        if self.book is None: self.book = self.conn.client._open_spreadsheet(spreadsheet=SHEET_URL)
+        return self.book
+
+    @storage_call
+    def read(self, worksheet_name):
+        data = self.conn.read(spreadsheet=SHEET_URL, worksheet=worksheet_name, ttl=0)
+        return data if data is not None else pd.DataFrame()
+
+    def stamp(self):
+        """Spreadsheet modified time: one Drive metadata call covers every worksheet"""
+        with span("gsheets.stamp"): return self._book().get_lastUpdateTime()
+
+    def changed_elsewhere(self, stamp):
+        """False when the new modified time falls inside one of this process's own writes"""
+        try: at = pd.Timestamp(stamp).timestamp()
+        except Exception: return True
+        return not any(start - self.STAMP_SKEW <= at <= end + self.STAMP_SKEW for start, end in self.own_writes)
+
+    @storage_call
+    @own_write
+    def replace(self, worksheet_name, data):
+        self.conn.update(spreadsheet=SHEET_URL, worksheet=worksheet_name, data=data.drop(columns=HELPER_COLS, errors='ignore'))
+
+    def worksheets(self):
+        if self.titles is None: self.titles = [ws.title for ws in self._book().worksheets()]
+        return self.titles
+
+    @own_write
+    def append(self, worksheet_name, rows):
+        """Appends rows, creating the worksheet the first time"""
+        if worksheet_name not in self.worksheets(): self.titles, self.sheets = None, {}  # Another process may have created it
+        if worksheet_name in self.worksheets(): return self.write_rows(worksheet_name, {"inserted": rows})
+        rows = with_row_meta(rows).drop(columns=HELPER_COLS, errors='ignore')
+        ws = self.sheets[worksheet_name] = self._book().add_worksheet(title=worksheet_name, rows=len(rows) + 1, cols=len(rows.columns))
+        self.titles = None
+        values = [list(rows.columns)] + [[_cell_value(v) for v in row] for row in rows.itertuples(index=False)]
+        ws.append_rows(values, value_input_option="USER_ENTERED", table_range="A1")
+        return [], []
+
+    @staticmethod
+    def _row(idx):
+        return int(idx) + 2  # Row 1 is the header; snapshot index keeps sheet positions
+
+    @staticmethod
+    def _runs(rows):
+        """Sorted row numbers as (first, last) runs of consecutive rows, so a block is deleted in one call"""
+        runs = []
+        for row in sorted(rows):
+            if runs and row == runs[-1][1] + 1: runs[-1][1] = row
+            else: runs.append([row, row])
+        return runs
+
+    def _header(self, ws, cols):
+        """Returns the sheet header, adding any columns it does not have yet"""
+        header = ws.row_values(1)
+        missing = [c for c in cols if c not in header and c not in HELPER_COLS]
+        if missing:
+            start = len(header) + 1
+            rng = f"{rowcol_to_a1(1, start)}:{rowcol_to_a1(1, start + len(missing) - 1)}"
+            ws.batch_update([{"range": rng, "values": [missing]}], value_input_option="USER_ENTERED")
+            header = header + missing
+        return header
+
+    def _worksheet(self, worksheet_name):
+        """Worksheet handle, looked up once on the cached spreadsheet; later calls go straight to its values"""
+        if worksheet_name not in self.sheets: self.sheets[worksheet_name] = self._book().worksheet(worksheet_name)
+        return self.sheets[worksheet_name]
+
+    @storage_call
+    def read_row(self, worksheet_name, row_id):
+        """One row by id: the header and the id column, then just that row"""
+        ws = self._worksheet(worksheet_name)
+        header = ws.row_values(1)
+        if "_row_id" not in header: return None
+        ids = ws.col_values(header.index("_row_id") + 1)
+        if row_id not in ids: return None
+        values = ws.row_values(ids.index(row_id) + 1)
+        return dict(zip(header, values + [""] * (len(header) - len(values))))
+
+    @storage_call
+    def row_ids(self, worksheet_name):
+        ws = self._worksheet(worksheet_name)
+        header = ws.row_values(1)
+        return set(ws.col_values(header.index("_row_id") + 1)[1:]) if "_row_id" in header else set()
+
+    @storage_call
+    @own_write
+    def assign_row_ids(self, worksheet_name, ids):
+        """Writes ids for the given snapshot rows in one update of the id column"""
+        ws = self._worksheet(worksheet_name)
+        header = self._header(ws, ROW_META)
+        col = header.index("_row_id") + 1
+        ws.batch_update([{"range": rowcol_to_a1(self._row(idx), col), "values": [[rid]]} for idx, rid in ids.items()], value_input_option="RAW")
+
+    @staticmethod
+    def _column(header, col):
+        letter = rowcol_to_a1(1, header.index(col) + 1)[:-1]
+        return f"{letter}2:{letter}"
+
+    def _locate(self, ws, header, base):
+        """(sheet row, current values) of each snapshot row, found by _row_id because positions shift when rows are
+        deleted; (None, None) when the row is gone. Rows from before ids existed keep their snapshot position."""
+        if base is None or base.empty: return {}
+        ids, revs = ws.batch_get([self._column(header, c) for c in ROW_META])
+        rows = {r[0]: i + 2 for i, r in enumerate(ids) if r and r[0]}
+        rev_at = {i + 2: r[0] for i, r in enumerate(revs) if r}
+        located, stale = {}, []
+        for idx, rid in base["_row_id"].items():
+            row = rows.get(rid) if rid else self._row(idx)
+            if row is None:
+                located[idx] = (None, None)
+                continue
+            located[idx] = (row, {"_row_id": rid, "_rev": rev_at.get(row, "")})
+            if _rev(rev_at.get(row)) != _rev(base.at[idx, "_rev"]): stale.append(idx)
+        if stale:
+            # Written by someone else since our snapshot: fetch those rows whole for the merge check
+            last = rowcol_to_a1(1, len(header))[:-1]
+            values = ws.batch_get([f"A{located[i][0]}:{last}{located[i][0]}" for i in stale])
+            for i, v in zip(stale, values): located[i][1].update(zip(header, v[0] if v else []))
+        return located
+
+    @storage_call
+    @own_write
+    def write_rows(self, worksheet_name, changes):
+        """Dirty cells with a revision bump, appended rows and deleted rows, checked against current revisions first;
+        returns (conflicting snapshot rows, merged snapshot rows), writing nothing if there are conflicts. Sheets has no
+        conditional update, so the check-to-write window is one round trip rather than a whole edit session."""
+        ws = self._worksheet(worksheet_name)
+        cells, inserted = dirty_cells(changes), with_row_meta(changes.get("inserted"))
+        cols = list(inserted.columns) if inserted is not None else []
+        header = self._header(ws, list(dict.fromkeys(cols + [col for _, col, _ in cells] + ROW_META)))
+        writes, deletes, conflicts, merged = conditional_rows(changes, self._locate(ws, header, changes.get("base")))
+        if conflicts: return conflicts, []
+        if writes:
+            ws.batch_update([
+                {"range": rowcol_to_a1(row, header.index(col) + 1), "values": [[_cell_value(val)]]}
+                for row, values in writes.items() for col, val in values.items()
+            ], value_input_option="USER_ENTERED")
+        if inserted is not None and not inserted.empty:
+            values = [[_cell_value(row.get(c)) for c in header] for row in inserted.to_dict("records")]
+            ws.append_rows(values, value_input_option="USER_ENTERED", table_range="A1")
+        for first, last in reversed(self._runs(deletes)):
+            ws.delete_rows(first, last)
+        return [], merged
+
+class SQLiteStorage:
+    """Embedded local engine: one table per worksheet, rows keyed by _pos, filter columns indexed"""
+    name = "sqlite"
+    INDEXED_COLS = ["Date", "Date Of Entry", "Order Date", "Item Name", "Party Name", "_row_id"]
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.lock = threading.RLock()
+
+    def _columns(self, table):
+        return [r[1] for r in self.db.execute(f"PRAGMA table_info({_q(table)})") if r[1] != "_pos"]
+
+    def stamp(self):
+        # Moves only when another connection (another server process) commits
+        with span("sqlite.stamp"), self.lock:
+            return self.db.execute("PRAGMA data_version").fetchone()[0]
+
+    def changed_elsewhere(self, stamp):
+        return True
+
+    def _ensure_columns(self, table, cols):
+        existing = self._columns(table)
+        if not existing:
+            self.db.execute(f"CREATE TABLE IF NOT EXISTS {_q(table)} (_pos INTEGER PRIMARY KEY AUTOINCREMENT)")
+        for col in dict.fromkeys(cols):
+            if col in existing or col in HELPER_COLS: continue
+            self.db.execute(f"ALTER TABLE {_q(table)} ADD COLUMN {_q(col)}")
+            if col in self.INDEXED_COLS:
+                self.db.execute(f"CREATE INDEX IF NOT EXISTS {_q(f'ix_{table}_{col}')} ON {_q(table)} ({_q(col)})")
+            existing.append(col)
+        return existing
+
+    def _insert(self, table, rows):
+        cols = [c for c in rows.columns if c not in HELPER_COLS]
+        sql = f"INSERT INTO {_q(table)} ({', '.join(map(_q, cols))}) VALUES ({', '.join('?' * len(cols))})"
+        self.db.executemany(sql, [[_sql_value(v) for v in row] for row in rows[cols].itertuples(index=False)])
+
+    def _select(self, table, where="", params=()):
+        with self.lock:
+            if not self._columns(table): return pd.DataFrame()
+            data = pd.read_sql_query(f"SELECT * FROM {_q(table)} {where} ORDER BY _pos", self.db, params=params)
+        data.index = pd.Index(data.pop("_pos") - 1)
+        return data
+
+    @storage_call
+    def read(self, worksheet_name):
+        return self._select(worksheet_name)
+
+    @storage_call
+    def read_range(self, worksheet_name, date_col, start, end):
+        """Indexed date-range query; dates are stored as YYYY-MM-DD text"""
+        with self.lock:
+            if date_col not in self._columns(worksheet_name): return pd.DataFrame()
+        where = f"WHERE {_q(date_col)} >= ? AND {_q(date_col)} < ?"
+        return self._select(worksheet_name, where, (str(start), str(end + timedelta(days=1))))
+
+    @staticmethod
+    def _filters(cols, date_col=None, bounds=None, searches=()):
+        """SQL conditions and arguments for a date range and (term, columns or None for all) searches"""
+        clauses, args = [], []
+        if bounds and date_col in cols:
+            clauses.append(f"{_q(date_col)} >= ? AND {_q(date_col)} < ?")
+            args += [str(bounds[0]), str(bounds[1] + timedelta(days=1))]
+        for term, search_cols in searches:
+            search_cols = [c for c in (search_cols or cols) if c in cols and c not in ROW_META]
+            if not term or not search_cols: continue
+            pattern = "%" + term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            clauses.append("(" + " OR ".join(f"CAST({_q(c)} AS TEXT) LIKE ? ESCAPE '\\'" for c in search_cols) + ")")
+            args += [pattern] * len(search_cols)
+        return clauses, args
+
+    @storage_call
+    def read_page(self, worksheet_name, date_col=None, bounds=None, searches=(), sort=None, offset=0, limit=10):
+        """One page plus the total match count"""
+        with self.lock:
+            cols = self._columns(worksheet_name)
+            if not cols: return pd.DataFrame(), 0
+            clauses, args = self._filters(cols, date_col, bounds, searches)
+            where = ("WHERE " + " AND ".join(clauses)) if clauses else ""
+            total = self.db.execute(f"SELECT COUNT(*) FROM {_q(worksheet_name)} {where}", args).fetchone()[0]
+            order = f"{_q(sort[0])} {'ASC' if sort[1] else 'DESC'}, _pos" if sort and sort[0] in cols else "_pos"
+            page = pd.read_sql_query(f"SELECT * FROM {_q(worksheet_name)} {where} ORDER BY {order} LIMIT ? OFFSET ?", self.db, params=args + [limit, offset])
+        page.index = pd.Index(page.pop("_pos") - 1)
+        return page, total
+
+    def read_chunks(self, worksheet_name, date_col=None, bounds=None, searches=(), size=5000):
+        """Matching rows in _pos order, one keyset-paged chunk at a time; the lock is held per chunk, not per export"""
+        last = 0
+        while True:
+            with self.lock:
+                cols = self._columns(worksheet_name)
+                if not cols: return
+                clauses, args = self._filters(cols, date_col, bounds, searches)
+                where = " AND ".join(["_pos > ?"] + clauses)
+                chunk = pd.read_sql_query(f"SELECT * FROM {_q(worksheet_name)} WHERE {where} ORDER BY _pos LIMIT ?", self.db, params=[last] + args + [size])
+            if chunk.empty: return
+            last = int(chunk["_pos"].iloc[-1])
+            chunk.index = pd.Index(chunk.pop("_pos") - 1)
+            yield chunk
+
+    @storage_call
+    def replace(self, worksheet_name, data):
+        with self.lock, self.db:
+            self.db.execute(f"DROP TABLE IF EXISTS {_q(worksheet_name)}")
+            self._ensure_columns(worksheet_name, list(data.columns))
+            self._insert(worksheet_name, data)
+
+    @storage_call
+    def read_row(self, worksheet_name, row_id):
+        with self.lock:
+            if "_row_id" not in self._columns(worksheet_name): return None
+            cur = self.db.execute(f"SELECT * FROM {_q(worksheet_name)} WHERE _row_id = ?", (row_id,))
+            row = cur.fetchone()
+            return {k: v for k, v in zip([d[0] for d in cur.description], row) if k != "_pos"} if row else None
+
+    @storage_call
+    def assign_row_ids(self, worksheet_name, ids):
+        with self.lock, self.db:
+            self._ensure_columns(worksheet_name, ROW_META)
+            self.db.executemany(f"UPDATE {_q(worksheet_name)} SET _row_id = ? WHERE _pos = ? AND COALESCE(_row_id, '') = ''",
+                                [(rid, int(idx) + 1) for idx, rid in ids.items()])
+
+    @storage_call
+    def row_ids(self, worksheet_name):
+        with self.lock:
+            if "_row_id" not in self._columns(worksheet_name): return set()
+            return {r[0] for r in self.db.execute(f"SELECT _row_id FROM {_q(worksheet_name)}")}
+
+    def worksheets(self):
+        with self.lock:
+            return [r[0] for r in self.db.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")]
+
+    def append(self, worksheet_name, rows):
+        return self.write_rows(worksheet_name, {"inserted": rows})
+
+    def _locate(self, table, base):
+        located = {}
+        for idx, rid in (base["_row_id"].items() if base is not None else []):
+            cur = self.db.execute(f"SELECT * FROM {_q(table)} WHERE {'_row_id' if rid else '_pos'} = ?", (rid or int(idx) + 1,))
+            row = cur.fetchone()
+            now = dict(zip([d[0] for d in cur.description], row)) if row else None
+            located[idx] = (now["_pos"] if now else None, now)
+        return located
+
+    @storage_call
+    def write_rows(self, worksheet_name, changes):
+        """One immediate transaction: rows are found by _row_id and updated only at the revision they were checked at.
+        Returns (conflicting snapshot rows, merged snapshot rows); nothing is written if there are conflicts."""
+        t, cells, inserted = _q(worksheet_name), dirty_cells(changes), with_row_meta(changes.get("inserted"))
+        with self.lock, self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            cols = list(inserted.columns) if inserted is not None else []
+            self._ensure_columns(worksheet_name, cols + [col for _, col, _ in cells] + ROW_META)
+            writes, deletes, conflicts, merged = conditional_rows(changes, self._locate(worksheet_name, changes.get("base")))
+            if conflicts: return conflicts, []
+            for pos, values in writes.items():
+                sql = f"UPDATE {t} SET {', '.join(f'{_q(c)} = ?' for c in values)} WHERE _pos = ? AND CAST(COALESCE(_rev, 0) AS INTEGER) = ?"
+                if self.db.execute(sql, [_sql_value(v) for v in values.values()] + [pos, values["_rev"] - 1]).rowcount == 0:
+                    self.db.rollback()
+                    return [pos], []
+            if inserted is not None and not inserted.empty: self._insert(worksheet_name, inserted)
+            self.db.executemany(f"DELETE FROM {t} WHERE _pos = ?", [(pos,) for pos in deletes])
+        return [], merged
+
+@st.cache_resource
+def _open_storage(engine, path):
+    if engine == "sqlite": return SQLiteStorage(path)
+    return GSheetsStorage(st.connection("gsheets", type=GSheetsConnection))
+
+def storage():
+    return _open_storage(STORAGE_ENGINE, STORAGE.get("path", "amavik.db"))
+
+def copy_worksheets(source, target, worksheets=None):
+    """Copies whole worksheets between engines, e.g. Google Sheets into the local database, archives included"""
+    if worksheets is None: worksheets = WORKSHEETS + [n for n in source.worksheets() if ARCHIVE_SEP in n]
+    for name in worksheets:
+        try: target.replace(name, source.read(name))
+        except Exception as e: st.warning(f"Could not copy {name}: {e}")
+        invalidate_sheet(name)
+
 try:
-    conn = st.connection("gsheets", type=GSheetsConnection)
+    storage()
 except Exception as e:
     st.error(f"🚨 Connection Error: {e}")
     st.stop()
 
+# ------------------------------------------------------------------
+# 6.1 WORKSHEET SNAPSHOTS (ONE FETCH PER SHEET PER RERUN)
+# ------------------------------------------------------------------
+SNAPSHOT_TTL = 60  # Seconds; refresh period when the engine cannot report a change stamp
+STAMP_INTERVAL = 10  # Seconds between change probes, shared by every session
+LOAD_WORKERS = 4  # Concurrent worksheet reads; stays well inside the Sheets API per-user quota
+LOAD_RETRIES = 2
+WARMUP_AT = STORAGE.get("warmup_at", [])  # [storage] warmup_at = "08:30" or a list: server-local times to re-read every sheet
+MODULE_SHEETS = {
+    "Dashboard": ["Ecommerce", "Production", "Store"],
+    "Order": ["Order"], "Production": ["Production"], "Packing": ["Packing"],
+    "Store": ["Store", "Packing"], "Ecommerce": ["Ecommerce"],
+}
+
+@st.cache_resource
+def _sheet_versions():
+    # Process-wide so a write in one session invalidates the snapshot for all
+    return {}
+
+@st.cache_resource
+def _stamp_state():
+    return {"probed": 0.0, "stamp": None, "epoch": 0}
+
+@st.cache_resource
+def _derived_store():
+    return {}
+
+DERIVED_UPDATERS = {}  # {worksheet: {name: fn(value, old_rows, new_rows)}} rolls aggregates forward on write; None = rebuild
+
+# Declared column types: coerced once per snapshot so views work on typed data
+SCHEMAS = {
+    "Order": {"Date": "date", "Qty": "number", "Transaction Type": "text"},
+    "Production": {"Date": "date", "Priority": "number", "Quantity": "number", "Ready Qty": "number", "Status": "status"},
+    "Packing": {"Date": "date", "Order Date": "date", "Order Priority": "number", "Qty": "number", "Ready Qty": "number", "Status": "status"},
+    "Store": {"Date Of Entry": "date", "Qty": "number", "Type": "text", "Transaction Type": "text"},
+    "Ecommerce": {"Date": "date", "Today's Order": "number", "Today's Dispatch": "number", "Return": "number", "Channel Name": "text"},
+}
+
+def typed(df, worksheet_name):
+    """Applies the worksheet schema in one vectorized pass; declared columns the sheet lacks are added empty"""
+    schema = SCHEMAS.get(worksheet_name.split(ARCHIVE_SEP)[0])  # Archive partitions share their worksheet's schema
+    if df is None or df.empty or not schema: return df
+    df = df.copy()
+    for col, kind in schema.items():
+        values = df[col] if col in df.columns else pd.Series(None, index=df.index, dtype=object)
+        if kind == "number": df[col] = pd.to_numeric(values, errors='coerce')
+        elif kind == "date": df[col] = pd.to_datetime(values, errors='coerce')
+        else:
+            blank = values.isna() | (values.astype(str).str.strip() == "")
+            values = values.astype(object).mask(blank, "Pending" if kind == "status" else None)
+            df[col] = values.astype("category") if kind == "status" else values  # Free text stays open to new values
+    df["_row_id"] = df["_row_id"].map(_cell_value).astype(str) if "_row_id" in df.columns else ""
+    df["_rev"] = pd.to_numeric(df["_rev"], errors="coerce").fillna(0).astype("int64") if "_rev" in df.columns else 0
+    return df
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def _fetch_sheet(worksheet_name, version):
+    data = typed(storage().read(worksheet_name), worksheet_name)
+    blank = data["_row_id"] == "" if data is not None and not data.empty else pd.Series(dtype=bool)
+    if blank.any():
+        # Rows written before row ids existed get theirs once, on the first read
+        data.loc[blank, "_row_id"] = [new_row_id() for _ in range(blank.sum())]
+        try: storage().assign_row_ids(worksheet_name, data.loc[blank, "_row_id"])
+        except Exception: data.loc[blank, "_row_id"] = ""
+    return data
+
+_RUN_SNAPSHOTS = {}  # Module globals reset on every rerun
+
+def _epoch():
+    """Counts edits made outside this process. The engines only report a change marker for the whole spreadsheet or
+    database, so it is probed once per STAMP_INTERVAL for every worksheet and session, and an edit elsewhere refreshes
+    all worksheets. Writes from this process already bump their worksheet's counter and are not counted again."""
+    state, now = _stamp_state(), time.time()
+    if now - state["probed"] >= STAMP_INTERVAL:
+        state["probed"] = now
+        engine = storage()
+        try: stamp, elsewhere = engine.stamp(), None
+        except Exception: stamp, elsewhere = int(now // SNAPSHOT_TTL), True
+        if stamp != state["stamp"]:
+            if state["stamp"] is not None and (elsewhere or engine.changed_elsewhere(stamp)): state["epoch"] += 1
+            state["stamp"] = stamp
+    return state["epoch"]
+
+def _version_of(versions, worksheet_name):
+    # (writes from this process, edits made elsewhere)
+    return (versions.get(worksheet_name, 0), _epoch())
+
+def sheet_version(worksheet_name):
+    return _version_of(_sheet_versions(), worksheet_name)
+
+def load_sheet(worksheet_name):
+    """Returns a private copy of the worksheet, fetched at most once per rerun"""
+    if worksheet_name not in _RUN_SNAPSHOTS:
+        data = _fetch_sheet(worksheet_name, sheet_version(worksheet_name))
+        pending = write_queue().pending_rows(worksheet_name)
+        if not pending.empty:
+            # Queued entries show up straight away, at the positions they will be appended to
+            start = int(data.index.max()) + 1 if not data.empty else 0
+            data = typed(pd.concat([data, pending.set_axis(range(start, start + len(pending)))]), worksheet_name)
+        _RUN_SNAPSHOTS[worksheet_name] = data
+    return _RUN_SNAPSHOTS[worksheet_name].copy()
+
+def sheets_for(modules):
+    return list(dict.fromkeys(name for module in modules for name in MODULE_SHEETS.get(module, [])))
+
+def _fetch_with_retry(worksheet_name):
+    for attempt in range(LOAD_RETRIES + 1):
+        try: return _fetch_sheet(worksheet_name, sheet_version(worksheet_name))
+        except Exception:
+            if attempt == LOAD_RETRIES: raise
+            time.sleep(0.5 * 2 ** attempt)
+
+def prefetch_sheets(worksheet_names):
+    """Reads worksheets concurrently into the shared snapshot cache, each retried on its own.
+    Returns {worksheet: error} for the ones that still failed; the rest are usable straight away."""
+    ctx = get_script_run_ctx(suppress_warning=True)
+    with ThreadPoolExecutor(max_workers=LOAD_WORKERS, initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx)) as pool:
+        futures = {name: pool.submit(_fetch_with_retry, name) for name in worksheet_names}
+    return {name: f.exception() for name, f in futures.items() if f.exception() is not None}
+
+def warm_up(modules):
+    """Starts reading a role's worksheets in the background, so its first screen paints from a warm cache"""
+    thread = threading.Thread(target=prefetch_sheets, args=(sheets_for(modules),), name="warm-up", daemon=True)
+    add_script_run_ctx(thread, get_script_run_ctx())
+    thread.start()
+
+def _next_run(now, at):
+    hour, minute = map(int, at.split(":"))
+    due = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    return due if due > now else due + timedelta(days=1)
+
+@st.cache_resource
+def _warmup_schedule(times):
+    # One daemon per process; a sheet read after the warm-up has a new change stamp and simply misses the cache
+    def run():
+        while True:
+            now = datetime.now()
+            time.sleep((min(_next_run(now, at) for at in times) - now).total_seconds())
+            try: prefetch_sheets(WORKSHEETS)
+            except Exception: pass
+    if times: threading.Thread(target=run, name="warm-up-schedule", daemon=True).start()
+    return times
+
+def warmup_times(setting):
+    """Validated HH:MM entries of the warmup_at setting (one string or a list)"""
+    times = [setting] if isinstance(setting, str) else list(setting)
+    for at in times:
+        try: datetime.strptime(str(at), "%H:%M")
+        except ValueError: raise ValueError(f"[storage] warmup_at: expected HH:MM, got {at!r}")
+    return tuple(str(at) for at in times)
+
+try:
+    _warmup_schedule(warmup_times(WARMUP_AT))
+except Exception as e:
+    st.error(f"🚨 Configuration Error: {e}")
+    st.stop()
+
+def load_range(worksheet_name, date_col, start, end):
+    """Rows with date_col in [start, end]: an indexed query where the engine has one, else a snapshot filter"""
+    if hasattr(storage(), "read_range"):
+        return derived(worksheet_name, f"range:{date_col}:{start}:{end}", lambda: typed(storage().read_range(worksheet_name, date_col, start, end), worksheet_name)).copy()
+    data = load_sheet(worksheet_name)
+    if data.empty or date_col not in data.columns: return pd.DataFrame()
+    return data[in_date_range(data[date_col], start, end)]
+
+def derived(worksheet_name, name, build):
+    """Memoizes an aggregate built from a worksheet until its snapshot version changes"""
+    store = _derived_store().setdefault(worksheet_name, {})
+    version = sheet_version(worksheet_name)
+    hit = store.get(name)
+    if hit is None or hit[0] != version:
+        hit = store[name] = (version, build())
+    return hit[1]
+
+def _republish(versions, store, worksheet_name):
+    """New version for a worksheet whose visible content is unchanged (queued rows synced); derived values carry over"""
+    old = _version_of(versions, worksheet_name)
+    versions[worksheet_name] = versions.get(worksheet_name, 0) + 1
+    new, entries = _version_of(versions, worksheet_name), store.get(worksheet_name, {})
+    for name, (version, value) in list(entries.items()):
+        if version == old: entries[name] = (new, value)
+
+def invalidate_sheet(worksheet_name=None):
+    """Bumps the snapshot version of one worksheet (or all of them) after a write"""
+    versions = _sheet_versions()
+    names = [worksheet_name] if worksheet_name else set(WORKSHEETS) | set(versions) | set(_RUN_SNAPSHOTS) | set(_derived_store())
+    for name in names:
+        versions[name] = versions.get(name, 0) + 1
+        _RUN_SNAPSHOTS.pop(name, None)
+        _derived_store().pop(name, None)
+
+def finish_write(sheet_name, message, icon, old_rows=None, new_rows=None):
+    """Invalidates only the written worksheet and confirms on the next run, without blocking"""
+    old_version, before = sheet_version(sheet_name), dict(_derived_store().get(sheet_name, {}))
+    invalidate_sheet(sheet_name)
+    if old_rows is not None or new_rows is not None:
+        # Roll maintained aggregates forward by the written rows instead of rebuilding them
+        old_rows = typed(old_rows, sheet_name) if old_rows is not None else pd.DataFrame()
+        new_rows = typed(new_rows, sheet_name) if new_rows is not None else pd.DataFrame()
+        for name, update in DERIVED_UPDATERS.get(sheet_name, {}).items():
+            if name in before and before[name][0] == old_version:
+                try: value = update(before[name][1], old_rows, new_rows)
+                except Exception: value = None
+                if value is not None: _derived_store().setdefault(sheet_name, {})[name] = (sheet_version(sheet_name), value)
+    st.session_state["flash"] = (message, icon)
+    st.session_state["edit_row"] = None
+    st.rerun()
+
 def safe_int(val):
     try:
         num = pd.to_numeric(val, errors='coerce')
@@ -298,85 +967,777 @@ def safe_float(val):
 def smart_format(val):
     try:
         num = float(val)
+        if math.isnan(num): return 0
         if num.is_integer():
             return int(num)
         return round(num, 1) # Max 1 decimal
     except:
         return 0
 
-def filter_by_date(df, filter_option, date_col_name="Date"):
-    if df.empty: return df
-    df = df.copy() 
-    if date_col_name not in df.columns: return df
-    df["temp_date"] = pd.to_datetime(df[date_col_name], errors='coerce').dt.date
+def date_bounds(filter_option):
+    """Inclusive (start, end) dates for a named date filter; None means no filtering"""
     today = date.today()
-    mask = pd.Series([False] * len(df))
-    if filter_option == "All": return df.drop(columns=["temp_date"], errors='ignore')
-    elif filter_option == "Today": mask = df["temp_date"] == today
-    elif filter_option == "Yesterday": mask = df["temp_date"] == (today - timedelta(days=1))
-    elif filter_option == "Prev 7 Days": mask = (df["temp_date"] >= (today - timedelta(days=7))) & (df["temp_date"] < today)
-    elif filter_option == "Prev 15 Days": mask = (df["temp_date"] >= (today - timedelta(days=15))) & (df["temp_date"] < today)
-    elif filter_option == "Prev 30 Days": mask = (df["temp_date"] >= (today - timedelta(days=30))) & (df["temp_date"] < today)
-    elif filter_option == "Prev All": mask = df["temp_date"] < today
-    elif filter_option == "This Month": mask = (df["temp_date"] >= today.replace(day=1)) & (df["temp_date"] <= today)
-    return df[mask].drop(columns=["temp_date"], errors='ignore')
-
-def save_smart_update(original_data, edited_subset, sheet_name):
+    yesterday = today - timedelta(days=1)
+    return {
+        "Today": (today, today),
+        "Yesterday": (yesterday, yesterday),
+        "Prev 7 Days": (today - timedelta(days=7), yesterday),
+        "Prev 15 Days": (today - timedelta(days=15), yesterday),
+        "Prev 30 Days": (today - timedelta(days=30), yesterday),
+        "Prev All": (date.min, yesterday),
+        "This Month": (today.replace(day=1), today),
+    }.get(filter_option)
+
+DAY_MIN, DAY_MAX = date(1700, 1, 1), date(2200, 1, 1)  # Clamp open-ended ranges to what datetime64 can hold
+
+def in_date_range(dates, start, end):
+    """Mask for rows whose datetime falls on a day within [start, end]"""
+    if not pd.api.types.is_datetime64_any_dtype(dates): dates = pd.to_datetime(dates, errors='coerce')
+    lo, hi = (pd.Timestamp(min(max(d, DAY_MIN), DAY_MAX)) for d in (start, end))
+    return (dates >= lo) & (dates < hi + pd.Timedelta(days=1))
+
+def filter_by_date(df, filter_option, date_col_name="Date"):
+    bounds = date_bounds(filter_option)
+    if df.empty or date_col_name not in df.columns or bounds is None: return df
+    return df[in_date_range(df[date_col_name], *bounds)]
+
+# ------------------------------------------------------------------
+# 6.2 ROW-LEVEL WRITES (CONDITIONAL ON ROW REVISIONS)
+# ------------------------------------------------------------------
+HELPER_COLS = ["_dt_obj", "temp_date", "dt"]
+ROW_META = ["_row_id", "_rev"]  # Stored with every row, never shown: stable identity and a counter bumped on each write
+
+def _cell_value(val):
+    if isinstance(val, (list, dict)): return str(val)
+    if val is None or pd.isna(val): return ""
+    if isinstance(val, (pd.Timestamp, datetime)): return val.strftime("%Y-%m-%d")
+    if isinstance(val, date): return str(val)
+    if isinstance(val, np.generic): val = val.item()
+    if isinstance(val, float) and val.is_integer(): return int(val)
+    return val
+
+def new_row_id():
+    return "r" + uuid.uuid4().hex[:12]  # Letter prefix keeps Sheets from reading an id as a number
+
+def _rev(val):
+    try: return int(float(val))
+    except (TypeError, ValueError): return 0
+
+def _same(a, b):
+    a, b = str(_cell_value(a)), str(_cell_value(b))
+    if a == b: return True
+    try: return float(a) == float(b)
+    except ValueError: return False
+
+def row_key(row, idx):
+    """How cards and forms refer to a row: its id, or its position until it has one"""
+    return row.get("_row_id") or idx
+
+def row_index(data, key):
+    """Snapshot position of the row a key refers to, or None when that row is no longer there"""
+    if "_row_id" in data.columns:
+        hits = data.index[data["_row_id"] == key]
+        if len(hits): return hits[0]
+    return key if not isinstance(key, str) and key in data.index else None
+
+def with_row_meta(rows):
+    """New rows get an id (unless they carry one) and their first revision"""
+    if rows is None or rows.empty: return rows
+    rows = rows.copy()
+    ids = rows["_row_id"].map(_cell_value).astype(str) if "_row_id" in rows.columns else [""] * len(rows)
+    rows["_row_id"] = [i or new_row_id() for i in ids]
+    rows["_rev"] = 1
+    return rows
+
+def change_base(original_data, idx):
+    """Snapshot rows a change set touches, as the base for its revision check"""
+    return original_data.loc[list(idx)].reindex(columns=list(dict.fromkeys([*original_data.columns, *ROW_META]))).fillna({"_row_id": "", "_rev": 0})
+
+def conditional_rows(changes, located):
+    """Checks a change set against the rows as they are now: ({row: {column: value}} to write, rows to delete, conflicts,
+    merged). located maps each base row to (engine row, current values), or (None, None) when it is gone. A row whose
+    revision moved is merged when the other writer left our cells alone; any conflict rejects the whole set. merged lists
+    the snapshot rows that no longer match the caller's copy, so its before/after rows are not the stored ones."""
+    base, updated, changed = changes.get("base"), changes.get("updated"), changes.get("changed")
+    deleted, writes, deletes, conflicts, merged = set(changes.get("deleted", [])), {}, [], [], []
+    for idx, (row, now) in located.items():
+        if now is None:
+            if idx in deleted: merged.append(idx)  # Deleting a row that is already gone is a no-op
+            else: conflicts.append(idx)
+            continue
+        rev = _rev(now.get("_rev"))
+        cols = [] if idx in deleted or changed is None or idx not in changed.index else list(changed.columns[changed.loc[idx]])
+        if rev != _rev(base.at[idx, "_rev"]) and (idx in deleted or any(
+                not _same(now.get(c), base.at[idx, c]) and not _same(now.get(c), updated.at[idx, c]) for c in cols)):
+            conflicts.append(idx)
+            continue
+        if rev != _rev(base.at[idx, "_rev"]): merged.append(idx)
+        if idx in deleted: deletes.append(row)
+        elif cols: writes[row] = {**{c: updated.at[idx, c] for c in cols}, "_row_id": _cell_value(now.get("_row_id")) or new_row_id(), "_rev": rev + 1}
+    return writes, deletes, conflicts, merged
+
+def conflict_message(conflicts):
+    return f"⚠️ {len(conflicts)} row(s) were changed by someone else since you loaded them. Their changes were kept; re-apply yours on the refreshed data."
+
+def _comparable(df):
+    out = df.copy()
+    for c in out.columns:
+        if pd.api.types.is_datetime64_any_dtype(out[c]): out[c] = out[c].dt.strftime("%Y-%m-%d")
+        elif out[c].dtype == object: out[c] = out[c].map(_cell_value)
+    return out.astype(object).where(out.notna(), "").astype(str)
+
+def diff_changes(original_data, edited_rows, shown_idx=None):
+    """Diffs edited rows against the snapshot in bulk, aligned on _row_id.
+    Returns {"updated": new row values, "changed": bool mask of dirty cells, "inserted": new rows, "deleted": row ids,
+    "base": the touched rows as read}"""
+    cols = [c for c in original_data.columns if c not in HELPER_COLS and c in edited_rows.columns]
+    ids = edited_rows.get("_row_id", pd.Series("", index=edited_rows.index)).map(_cell_value).astype(str)
+    by_id = pd.Series(original_data.index, index=original_data.get("_row_id", pd.Series("", index=original_data.index)))
+    idx = ids.map(by_id[(by_id.index != "") & ~by_id.index.duplicated()])
+    # Rows without an id yet align on their snapshot position
+    unnamed = (ids == "") & edited_rows.index.isin(original_data.index)
+    idx = idx.mask(unnamed, pd.Series(edited_rows.index, index=edited_rows.index))
+    known = idx.notna()
+
+    after = edited_rows.loc[known, cols].set_axis(idx[known].astype("int64"), axis=0)
+    before = original_data.loc[after.index, cols]
+    a, b = _comparable(before), _comparable(after)
+    num_a, num_b = a.apply(pd.to_numeric, errors="coerce"), b.apply(pd.to_numeric, errors="coerce")
+    changed = ~((a == b) | (num_a == num_b))
+    dirty_rows = changed.any(axis=1)
+
+    inserted = edited_rows.loc[(ids == "") & ~unnamed, [c for c in edited_rows.columns if c not in HELPER_COLS]]
+    deleted = list(pd.Index(shown_idx).difference(idx.dropna())) if shown_idx is not None else []
+    return {"updated": after[dirty_rows], "changed": changed[dirty_rows], "inserted": inserted.reset_index(drop=True), "deleted": deleted,
+            "base": change_base(original_data, list(after.index[dirty_rows]) + deleted)}
+
+def has_changes(changes):
+    return bool(changes["changed"].any(axis=None) or not changes["inserted"].empty or changes["deleted"])
+
+def apply_changes(original_data, changes):
+    """Merges a change set into the snapshot in one pass"""
+    merged = original_data.drop(index=changes.get("deleted", []), errors="ignore")
+    updated, changed = changes.get("updated"), changes.get("changed")
+    if updated is not None and not updated.empty:
+        cols = list(changed.columns[changed.any()])
+        merged[cols] = merged[cols].astype(object)
+        merged.loc[updated.index, cols] = merged.loc[updated.index, cols].where(~changed[cols], updated[cols])
+    inserted = changes.get("inserted")
+    if inserted is not None and not inserted.empty:
+        merged = pd.concat([merged, inserted], ignore_index=True)
+    return merged
+
+def changed_rows(original_data, changes):
+    """Returns (rows as they were, rows as they are now) for a change set"""
+    updated = changes.get("updated", pd.DataFrame())
+    touched = original_data.index.intersection(list(updated.index) + list(changes.get("deleted", [])))
+    new_rows = apply_changes(original_data.loc[updated.index], {"updated": updated, "changed": changes.get("changed")})
+    inserted = changes.get("inserted", pd.DataFrame())
+    start = int(original_data.index.max()) + 1 if not original_data.empty else 0
+    new_rows = pd.concat([new_rows, inserted.set_axis(range(start, start + len(inserted)))])
+    return original_data.loc[touched], new_rows
+
+def dirty_cells(changes):
+    """Flattens a change set into (row id, column, new value) triples"""
+    changed = changes.get("changed")
+    if changed is None or changed.empty: return []
+    cells = changed.stack()
+    return [(idx, col, changes["updated"].at[idx, col]) for idx, col in cells[cells].index]
+
+def _amend_queued(original_data, changes, sheet_name):
+    """Applies edits and deletes of entries still waiting in the write queue to the queue; returns the rest of the set"""
+    pending = write_queue().pending_rows(sheet_name)
+    if pending.empty or "_row_id" not in pending.columns or "_row_id" not in original_data.columns: return changes
+    ids, queued = original_data["_row_id"], set(pending["_row_id"])
+    updates = {}
+    for idx, col, val in dirty_cells(changes):
+        if ids.get(idx) in queued: updates.setdefault(ids[idx], {})[col] = _cell_value(val)
+    deletes = {ids[idx] for idx in changes.get("deleted", []) if ids.get(idx) in queued}
+    amended = (set(updates) | deletes) - write_queue().amend(sheet_name, updates, deletes)
+    if not amended: return changes
+    done = original_data.index[ids.isin(amended)]
+    rest = dict(changes, deleted=[idx for idx in changes.get("deleted", []) if idx not in done])
+    for key in ["updated", "changed", "base"]:
+        if rest.get(key) is not None: rest[key] = rest[key].drop(index=done, errors="ignore")
+    return rest
+
+def write_changes(original_data, changes, sheet_name):
+    """Writes a change set and returns (conflicts, merged rows). Entries not synced yet are changed in the write queue,
+    since storage has no row to update."""
+    changes = _amend_queued(original_data, changes, sheet_name)
+    inserted = changes.get("inserted")
+    if not dirty_cells(changes) and not changes.get("deleted") and (inserted is None or inserted.empty): return [], []
+    return storage().write_rows(sheet_name, changes)
+
+def save_smart_update(original_data, edited_subset, sheet_name, changes=None):
     try:
-        all_cols = [c for c in original_data.columns if c != "_original_idx"]
-        for i, row in edited_subset.iterrows():
-            idx = row.get("_original_idx")
-            if pd.notna(idx) and idx in original_data.index:
-                for col in all_cols:
-                    if col in row: original_data.at[idx, col] = row[col]
-            elif pd.isna(idx):
-                new_data = {col: row[col] for col in all_cols if col in row}
-                original_data = pd.concat([original_data, pd.DataFrame([new_data])], ignore_index=True)
-        final = original_data.drop(columns=["_original_idx"], errors='ignore')
-        conn.update(spreadsheet=SHEET_URL, worksheet=sheet_name, data=final)
-        st.toast("✅ Saved!", icon="💾")
-        st.session_state["edit_idx"] = None
-        st.cache_data.clear()
-        time.sleep(1)
-        st.rerun()
+        if changes is None: changes = diff_changes(original_data, edited_subset)
+        conflicts, merged = write_changes(original_data, changes, sheet_name)
+        if conflicts:
+            invalidate_sheet(sheet_name)
+            return st.warning(conflict_message(conflicts))
+        if merged: return finish_write(sheet_name, "✅ Saved!", "💾")  # Our snapshot rows are stale: rebuild, don't roll
+        old_rows, new_rows = changed_rows(original_data, changes)
+        finish_write(sheet_name, "✅ Saved!", "💾", old_rows, new_rows)
     except Exception as e: st.error(f"Error saving data: {e}")
 
-def save_new_row(original_data, new_row_df, sheet_name):
+def save_new_row(original_data, new_row_df, sheet_name, message="✅ Entry Added!"):
     try:
-        original_clean = original_data.drop(columns=["_original_idx"], errors='ignore')
-        updated = pd.concat([original_clean, new_row_df], ignore_index=True)
-        conn.update(spreadsheet=SHEET_URL, worksheet=sheet_name, data=updated)
-        st.toast("✅ Entry Added!", icon="➕")
-        st.cache_data.clear()
-        time.sleep(1)
-        st.rerun()
+        new_row_df = with_row_meta(new_row_df)  # The id is fixed here: edits before the sync amend the queued entry
+        write_queue().enqueue(sheet_name, new_row_df)
+        start = int(original_data.index.max()) + 1 if not original_data.empty else 0
+        finish_write(sheet_name, message, "➕", new_rows=new_row_df.set_axis(range(start, start + len(new_row_df))))
     except Exception as e: st.error(f"Error adding row: {e}")
 
-def delete_task(original_data, index_to_delete, sheet_name):
+def delete_task(original_data, key, sheet_name):
     try:
-        if index_to_delete in original_data.index:
-            updated_data = original_data.drop(index_to_delete)
-            final = updated_data.drop(columns=["_original_idx", "_dt_obj", "temp_date", "dt"], errors='ignore')
-            conn.update(spreadsheet=SHEET_URL, worksheet=sheet_name, data=final)
-            st.toast("🗑️ Task Deleted!", icon="✅")
-            st.session_state["edit_idx"] = None
-            st.cache_data.clear()
-            time.sleep(1)
-            st.rerun()
+        index_to_delete = row_index(original_data, key)
+        if index_to_delete is not None:
+            conflicts, merged = write_changes(original_data, {"deleted": [index_to_delete], "base": change_base(original_data, [index_to_delete])}, sheet_name)
+            if conflicts:
+                invalidate_sheet(sheet_name)
+                return st.warning(conflict_message(conflicts))
+            if merged: return finish_write(sheet_name, "🗑️ Task Deleted!", "✅")  # Already gone: nothing to roll back out
+            finish_write(sheet_name, "🗑️ Task Deleted!", "✅", old_rows=original_data.loc[[index_to_delete]])
     except Exception as e: st.error(f"Error deleting: {e}")
 
+# ------------------------------------------------------------------
+# 6.3 STOCK LEDGER (MATERIALIZED STORE BALANCES)
+# ------------------------------------------------------------------
+STOCK_COLS = ["Item Name", "Type", "Inward", "Outward", "Balance"]
+
+def _stock_flows(store_rows):
+    if store_rows.empty or "Item Name" not in store_rows.columns:
+        return pd.DataFrame(columns=["Type", "Inward", "Outward", "Entries"])
+    qty = pd.to_numeric(store_rows.get("Qty", pd.Series(0, index=store_rows.index)), errors="coerce").fillna(0).astype(float)
+    trans = store_rows.get("Transaction Type", pd.Series("", index=store_rows.index))
+    flows = pd.DataFrame({
+        "Item Name": store_rows["Item Name"],
+        "Type": store_rows.get("Type", pd.Series("", index=store_rows.index)),
+        "Inward": qty.where(trans == "Inward", 0.0),
+        "Outward": qty.where(trans == "Outward", 0.0),
+    }).groupby("Item Name", sort=False)
+    out = flows[["Inward", "Outward"]].sum()
+    out.insert(0, "Type", flows["Type"].first())
+    out["Entries"] = flows.size()
+    return out
+
+def _stock_table(flows):
+    ledger = flows[flows["Entries"] > 0].copy()
+    ledger["Balance"] = ledger["Inward"] - ledger["Outward"]
+    return ledger
+
+def compute_stock_balance(store_rows):
+    """Per-item Inward, Outward and Balance in one vectorized pass"""
+    ledger = _stock_table(_stock_flows(store_rows)).sort_index()
+    return ledger.reset_index()[STOCK_COLS] if not ledger.empty else pd.DataFrame(columns=STOCK_COLS)
+
+def roll_stock_ledger(ledger, old_rows, new_rows):
+    added, removed, nums = _stock_flows(new_rows), _stock_flows(old_rows), ["Inward", "Outward", "Entries"]
+    flows = ledger[nums].add(added[nums], fill_value=0).sub(removed[nums], fill_value=0)
+    flows.insert(0, "Type", ledger["Type"].combine_first(added["Type"]).reindex(flows.index))
+    return _stock_table(flows).sort_index()
+
+def stock_ledger(store_data):
+    """Materialized per-item balances for the Store worksheet, rolled forward on every Store write"""
+    ledger = derived("Store", "stock", lambda: _stock_table(_stock_flows(store_data)).sort_index())
+    return ledger.reset_index()[STOCK_COLS] if not ledger.empty else pd.DataFrame(columns=STOCK_COLS)
+
+DERIVED_UPDATERS["Store"] = {"stock": roll_stock_ledger}
+
+# ------------------------------------------------------------------
+# 6.4 ORDER BALANCES (MATERIALIZED PENDING PER PARTY AND ITEM)
+# ------------------------------------------------------------------
+BALANCE_KEYS = ["Party Name", "Item Name"]
+BALANCE_COLS = BALANCE_KEYS + ["Order Received", "Dispatch", "Pending Balance"]
+
+def _order_flows(order_rows):
+    if order_rows.empty or not set(BALANCE_KEYS) <= set(order_rows.columns):
+        return pd.DataFrame(columns=["Order Received", "Dispatch", "Entries"], index=pd.MultiIndex.from_arrays([[], []], names=BALANCE_KEYS))
+    qty = pd.to_numeric(order_rows.get("Qty", pd.Series(0, index=order_rows.index)), errors="coerce").fillna(0).astype(float)
+    trans = order_rows.get("Transaction Type", pd.Series("", index=order_rows.index)).astype(object)
+    flows = pd.DataFrame({
+        "Party Name": order_rows["Party Name"].astype(object),
+        "Item Name": order_rows["Item Name"].astype(object),
+        "Order Received": qty.where(trans == "Order Received", 0.0),
+        "Dispatch": qty.where(trans == "Dispatch", 0.0),
+    }).groupby(BALANCE_KEYS, sort=False)
+    out = flows[["Order Received", "Dispatch"]].sum()
+    out["Entries"] = flows.size()
+    return out
+
+def _balance_table(flows):
+    balances = flows[flows["Entries"] > 0].copy()
+    balances["Pending Balance"] = balances["Order Received"] - balances["Dispatch"]
+    return balances
+
+def roll_order_balances(balances, old_rows, new_rows):
+    nums = ["Order Received", "Dispatch", "Entries"]
+    flows = balances[nums].add(_order_flows(new_rows)[nums], fill_value=0).sub(_order_flows(old_rows)[nums], fill_value=0)
+    return _balance_table(flows).sort_index()
+
+def order_balances(order_data):
+    """Materialized (Party, Item) pending balances for the Order worksheet, rolled forward on every Order write"""
+    balances = derived("Order", "balances", lambda: _balance_table(_order_flows(order_data)).sort_index())
+    return balances.reset_index()[BALANCE_COLS] if not balances.empty else pd.DataFrame(columns=BALANCE_COLS)
+
+DERIVED_UPDATERS["Order"] = {"balances": roll_order_balances}
+
+# ------------------------------------------------------------------
+# 6.5 ECOMMERCE DAILY ROLLUP (PREFIX SUMS BY DATE AND CHANNEL)
+# ------------------------------------------------------------------
+ECOM_METRICS = ["Today's Order", "Today's Dispatch", "Return"]
+
+def _ecom_daily(rows):
+    """Per-day sums with one column per (metric, channel)"""
+    if rows.empty or "Date" not in rows.columns: return pd.DataFrame()
+    rows = rows[rows["Date"].notna()]
+    metrics = rows.reindex(columns=ECOM_METRICS).apply(pd.to_numeric, errors="coerce").fillna(0)
+    channel = rows.get("Channel Name", pd.Series(None, index=rows.index)).astype(object)
+    keys = [rows["Date"].dt.normalize().rename("Date"), channel.rename("Channel Name")]
+    return metrics.groupby(keys, dropna=False).sum().unstack("Channel Name", fill_value=0)
+
+def _ecom_rollup(daily):
+    daily = daily.sort_index().sort_index(axis=1)
+    return daily, daily.cumsum()
+
+def roll_ecom_rollup(rollup, old_rows, new_rows):
+    daily = rollup[0]
+    for rows, sign in ((new_rows, 1), (old_rows, -1)):
+        part = _ecom_daily(rows) * sign
+        if not part.empty: daily = daily.add(part, fill_value=0).fillna(0) if not daily.empty else part
+    return _ecom_rollup(daily)
+
+def ecom_rollup():
+    """(daily sums, running totals) for Ecommerce, rolled forward on every Ecommerce write"""
+    return derived("Ecommerce", "daily", lambda: _ecom_rollup(_ecom_daily(load_sheet("Ecommerce"))))
+
+def _day_bounds(start, end):
+    return tuple(pd.Timestamp(min(max(d, DAY_MIN), DAY_MAX)) for d in (start, end))
+
+def window_sums(rollup, start, end):
+    """(metric, channel) sums over the days [start, end]: the difference of two prefix-sum rows"""
+    daily, cum = rollup
+    if cum.empty: return pd.Series(dtype=float)
+    lo, hi = _day_bounds(start, end)
+    a, b = cum.index.searchsorted(lo), cum.index.searchsorted(hi, side="right")
+    zero = cum.iloc[0] * 0
+    return (cum.iloc[b - 1] if b else zero) - (cum.iloc[a - 1] if a else zero)
+
+def period_totals(rollup, start, end, channel=None):
+    sums = window_sums(rollup, start, end)
+    if sums.empty: return pd.Series(0.0, index=ECOM_METRICS)
+    if channel is not None: sums = sums[sums.index.get_level_values("Channel Name") == channel]
+    return sums.groupby(level=0).sum().reindex(ECOM_METRICS, fill_value=0)
+
+def channel_totals(rollup, metric, start, end):
+    sums = window_sums(rollup, start, end)
+    if sums.empty: return pd.DataFrame(columns=["Channel Name", metric])
+    return sums[metric].rename(metric).reset_index().dropna(subset=["Channel Name"])
+
+def channel_report(rollup, start, end):
+    """Every metric per channel over [start, end], one row per channel"""
+    sums = window_sums(rollup, start, end)
+    if sums.empty: return pd.DataFrame(columns=["Channel Name", *ECOM_METRICS])
+    report = sums.unstack(level=0).reindex(columns=ECOM_METRICS, fill_value=0)
+    return report[report.index.notna()].rename_axis(columns=None).reset_index()
+
+def daily_series(rollup, metric, start, end):
+    """Long (Date, Channel Name, metric) rows for charting, read straight off the rollup"""
+    daily = rollup[0]
+    if daily.empty: return pd.DataFrame(columns=["Date", "Channel Name", metric])
+    lo, hi = _day_bounds(start, end)
+    window = daily.loc[lo:hi, metric]
+    return window.loc[:, window.columns.notna()].stack().rename(metric).reset_index()
+
+DERIVED_UPDATERS.setdefault("Ecommerce", {})["daily"] = roll_ecom_rollup
+
+# ------------------------------------------------------------------
+# 6.6 SEARCH INDEX (LOWERCASED ROW TEXT PER WORKSHEET)
+# ------------------------------------------------------------------
+SEARCH_SEP = "\x1f"  # keeps matches from running across cell boundaries
+
+def _cell_text(values):
+    """Cell text as the sheet shows it: ISO dates, whole numbers without a trailing .0, blanks for missing"""
+    if pd.api.types.is_datetime64_any_dtype(values): text = values.dt.strftime("%Y-%m-%d")
+    elif pd.api.types.is_float_dtype(values): text = values.astype(str).str.replace(r"\.0$", "", regex=True)
+    else: text = values.astype(str)
+    return text.where(values.notna(), "")
+
+def _search_text(rows, cols):
+    cols = [c for c in cols if c in rows.columns]
+    if rows.empty or not cols: return pd.Series("", index=rows.index, dtype=object)
+    text = _cell_text(rows[cols[0]])
+    for c in cols[1:]: text = text + SEARCH_SEP + _cell_text(rows[c])
+    return text.str.lower()
+
+def _search_keyed(rows, cols):
+    """Search text keyed by _row_id, which unlike the snapshot position survives deletes and queued rows syncing"""
+    if "_row_id" not in rows.columns: return pd.Series(dtype=object)
+    ids = rows["_row_id"].map(_cell_value).astype(str)
+    keep = (ids != "") & ~ids.duplicated(keep=False)
+    return _search_text(rows[keep], cols).set_axis(ids[keep])
+
+def search_index(worksheet_name, cols=None):
+    """Lowercased text of every row (or of just `cols`) by _row_id, built once per snapshot and rolled forward on writes"""
+    index = derived(worksheet_name, "search", dict)
+    key = tuple(cols) if cols else None
+    if key not in index:
+        data = load_sheet(worksheet_name)
+        key_cols = list(cols) if cols else [c for c in data.columns if c not in HELPER_COLS + ROW_META]
+        index[key] = (key_cols, _search_keyed(data, key_cols))
+    return index[key][1]
+
+def roll_search_index(index, old_rows, new_rows):
+    gone = old_rows["_row_id"].map(_cell_value).astype(str) if "_row_id" in old_rows.columns else []
+    rolled = {}
+    for key, (cols, text) in index.items():
+        fresh = _search_keyed(new_rows, cols)
+        rolled[key] = (cols, pd.concat([text.drop(list(gone) + list(fresh.index), errors="ignore"), fresh]))
+    return rolled
+
+def search_mask(df, query, cols=None, worksheet_name=None):
+    """Case-insensitive substring match per row; rows of a worksheet are answered from its search index,
+    and rows it does not hold (no id yet) are scanned directly"""
+    if worksheet_name and "_row_id" in df.columns:
+        text = search_index(worksheet_name, cols).reindex(df["_row_id"].map(_cell_value).astype(str)).set_axis(df.index)
+        missing = text.isna()
+        if missing.any(): text[missing] = _search_text(df[missing], cols or [c for c in df.columns if c not in HELPER_COLS + ROW_META])
+    else: text = _search_text(df, cols or [c for c in df.columns if c not in ROW_META])
+    return text.str.contains(query.lower(), regex=False)
+
+for _name in WORKSHEETS: DERIVED_UPDATERS.setdefault(_name, {})["search"] = roll_search_index
+
+# ------------------------------------------------------------------
+# 6.7 WRITE-BEHIND QUEUE (NEW ENTRIES SYNC IN THE BACKGROUND)
+# ------------------------------------------------------------------
+class WriteQueue:
+    """Durable local journal: new entries are accepted at once and flushed to storage by a worker thread"""
+    MAX_ATTEMPTS = 6
+    BATCH_SIZE = 200
+
+    def __init__(self, path, engine, on_synced):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS queue (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, worksheet TEXT, payload TEXT, status TEXT DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0, next_try REAL DEFAULT 0, error TEXT, created REAL)""")
+        # A batch cut off mid-sync by a restart may already be in storage; the error makes its retry check first
+        self.db.execute("UPDATE queue SET status = 'pending', error = 'interrupted' WHERE status = 'syncing'")
+        self.db.commit()
+        self.lock = threading.RLock()
+        self.wake = threading.Event()
+        self.engine, self.on_synced = engine, on_synced
+        threading.Thread(target=self._run, name="write-behind", daemon=True).start()
+
+    def enqueue(self, worksheet_name, rows):
+        records = [{k: _cell_value(v) for k, v in r.items() if k not in HELPER_COLS} for r in rows.to_dict("records")]
+        with self.lock, self.db:
+            self.db.execute("INSERT INTO queue (worksheet, payload, created) VALUES (?, ?, ?)", (worksheet_name, json.dumps(records), time.time()))
+        self.wake.set()
+
+    def pending_rows(self, worksheet_name):
+        with self.lock:
+            payloads = self.db.execute("SELECT payload FROM queue WHERE worksheet = ? ORDER BY id", (worksheet_name,)).fetchall()
+        return pd.DataFrame([row for (p,) in payloads for row in json.loads(p)])
+
+    def amend(self, worksheet_name, updates, deletes):
+        """Edits ({row id: {column: value}}) and deletes (row ids) of entries that are not syncing right now.
+        Returns the ids it could not change."""
+        done = set()
+        with self.lock, self.db:
+            queued = self.db.execute("SELECT id, payload FROM queue WHERE worksheet = ? AND status != 'syncing'", (worksheet_name,)).fetchall()
+            for qid, payload in queued:
+                rows = json.loads(payload)
+                kept = [{**row, **updates.get(row.get("_row_id"), {})} for row in rows if row.get("_row_id") not in deletes]
+                done |= {row.get("_row_id") for row in rows} & (set(updates) | set(deletes))
+                if not kept: self.db.execute("DELETE FROM queue WHERE id = ?", (qid,))
+                elif kept != rows: self.db.execute("UPDATE queue SET payload = ? WHERE id = ?", (json.dumps(kept), qid))
+        return (set(updates) | set(deletes)) - done
+
+    def counts(self):
+        with self.lock:
+            return dict(self.db.execute("SELECT status, COUNT(*) FROM queue GROUP BY status").fetchall())
+
+    def retry_failed(self):
+        with self.lock, self.db:
+            self.db.execute("UPDATE queue SET status = 'pending', attempts = 0, next_try = 0 WHERE status = 'failed'")
+        self.wake.set()
+
+    def _run(self):
+        while True:
+            self.wake.wait(timeout=5)
+            self.wake.clear()
+            try: self.flush()
+            except Exception: pass
+
+    def flush(self):
+        with self.lock, self.db:
+            queued = self.db.execute("SELECT id, worksheet, payload, attempts, next_try, error FROM queue WHERE status = 'pending' ORDER BY id LIMIT ?", (self.BATCH_SIZE,)).fetchall()
+            ready = {}
+            for q in queued: ready.setdefault(q[1], q[4] <= time.time())  # Oldest entry still backing off holds its sheet back (FIFO)
+            queued = [q for q in queued if ready[q[1]]]
+            # From here on edits can no longer go into the payload; they wait for the synced row instead
+            self.db.executemany("UPDATE queue SET status = 'syncing' WHERE id = ?", [(q[0],) for q in queued])
+        for worksheet_name in dict.fromkeys(q[1] for q in queued):
+            batch = [q for q in queued if q[1] == worksheet_name]
+            rows = pd.DataFrame([row for q in batch for row in json.loads(q[2])])
+            try:
+                if any(q[5] for q in batch) and "_row_id" in rows.columns:
+                    # An attempt that errored may still have been applied; skip rows storage already holds
+                    rows = rows[~rows["_row_id"].isin(self.engine.row_ids(worksheet_name))]
+                if not rows.empty: self.engine.write_rows(worksheet_name, {"inserted": rows})
+            except Exception as e:
+                attempts = max(q[3] for q in batch) + 1
+                status = "failed" if attempts >= self.MAX_ATTEMPTS else "pending"
+                with self.lock, self.db:
+                    self.db.executemany("UPDATE queue SET attempts = ?, status = ?, next_try = ?, error = ? WHERE id = ?",
+                                        [(attempts, status, time.time() + min(300, 2 ** attempts), str(e)[:500], q[0]) for q in batch])
+                continue
+            with self.lock, self.db:
+                self.db.executemany("DELETE FROM queue WHERE id = ?", [(q[0],) for q in batch])
+            self.on_synced(worksheet_name)
+
+@st.cache_resource
+def _open_write_queue(path, engine_name):
+    versions, store = _sheet_versions(), _derived_store()
+    return WriteQueue(path, storage(), lambda name: _republish(versions, store, name))
+
+def write_queue():
+    return _open_write_queue(STORAGE.get("queue_path", "amavik_queue.db"), STORAGE_ENGINE)
+
+@st.fragment(run_every=10)
+def render_sync_status():
+    counts = write_queue().counts()
+    pending, failed = counts.get("pending", 0) + counts.get("syncing", 0), counts.get("failed", 0)
+    if not pending and not failed: st.caption("☁️ All entries synced")
+    else: st.caption(f"🔄 Sync: {pending} pending · {failed} failed")
+    if failed and st.button("Retry Failed Sync", key="retry_sync", use_container_width=True):
+        write_queue().retry_failed()
+        st.rerun(scope="fragment")
+
+# ------------------------------------------------------------------
+# 6.8 BULK IMPORT (CSV / EXCEL INTO STORE AND ORDER)
+# ------------------------------------------------------------------
+IMPORT_CHUNK = 500
+IMPORT_RULES = {
+    "Store": {
+        "columns": ["Date Of Entry", "Recvd From", "Vendor Name(Brand)", "Type", "Item Name", "Qty", "UOM", "Transaction Type", "Invoice No."],
+        "required": ["Date Of Entry", "Item Name", "Qty", "Transaction Type"],
+        "choices": {"Transaction Type": ["Inward", "Outward"]},
+    },
+    "Order": {
+        "columns": ["Date", "Transaction Type", "Party Name", "Item Name", "Qty", "Remarks"],
+        "required": ["Date", "Transaction Type", "Party Name", "Item Name", "Qty"],
+        "choices": {"Transaction Type": ["Order Received", "Dispatch"]},
+    },
+}
+
+def _import_chunks(upload):
+    """Yields the file as string-typed chunks; CSV is streamed, Excel is read once and sliced"""
+    if upload.name.lower().endswith(".xlsx"):
+        sheet = pd.read_excel(upload, dtype=str).fillna("")
+        for start in range(0, len(sheet), IMPORT_CHUNK): yield sheet.iloc[start:start + IMPORT_CHUNK]
+    else: yield from pd.read_csv(upload, dtype=str, keep_default_na=False, chunksize=IMPORT_CHUNK, skipinitialspace=True)
+
+def _import_dates(values):
+    """ISO dates first, then day-first forms such as 17/10/2026, as YYYY-MM-DD text.
+    A value that starts with YYYY- is ISO or invalid: 2026-13-01 is rejected, not read as 13 January."""
+    iso = pd.to_datetime(values, errors="coerce", format="ISO8601")
+    rest = values.where(iso.isna() & ~values.astype(str).str.match(r"\d{4}-"))
+    rest = pd.to_datetime(rest, errors="coerce", format="mixed", dayfirst=True)
+    return iso.fillna(rest).dt.strftime("%Y-%m-%d")
+
+def _validate_chunk(chunk, worksheet_name):
+    rules = IMPORT_RULES[worksheet_name]
+    names = {c.lower(): c for c in rules["columns"]}
+    chunk = chunk.rename(columns=lambda c: names.get(str(c).strip().lower(), str(c).strip()))
+    raw = chunk.reindex(columns=rules["columns"], fill_value="").astype(str).apply(lambda s: s.str.strip())
+    for col, allowed in rules["choices"].items():
+        canon = {a.lower(): a for a in allowed}
+        raw[col] = raw[col].map(lambda v: canon.get(v.lower(), v))
+    rows = raw.mask(raw == "")
+    for col, kind in SCHEMAS[worksheet_name].items():
+        if kind == "date": rows[col] = _import_dates(rows[col])
+    rows = typed(rows, worksheet_name)
+
+    reasons = pd.Series("", index=raw.index)
+    def flag(mask, why): reasons[mask & (reasons == "")] = why
+    for col in rules["required"]: flag(raw[col] == "", f"{col} is missing")
+    for col, kind in SCHEMAS[worksheet_name].items():
+        if col in raw.columns and kind in ("date", "number"): flag((raw[col] != "") & rows[col].isna(), f"{col} is not a {kind}")
+    flag(rows["Qty"] <= 0, "Qty must be positive")
+    for col, allowed in rules["choices"].items(): flag(~raw[col].isin(allowed), f"{col} must be one of: {', '.join(allowed)}")
+
+    ok = reasons == ""
+    accepted = raw[ok].copy()
+    for col, kind in SCHEMAS[worksheet_name].items():
+        if kind == "date": accepted[col] = rows.loc[ok, col].dt.strftime("%Y-%m-%d")
+        elif kind == "number" and col in accepted.columns: accepted[col] = rows.loc[ok, col]
+    rejected = chunk[~ok].copy()
+    rejected.insert(0, "Reason", reasons[~ok])
+    rejected.insert(0, "Line", rejected.index + 2)  # Header is line 1
+    return accepted, rejected
+
+def validate_import(upload, worksheet_name):
+    """Checks and types an uploaded file chunk by chunk: (accepted rows ready to append, rejected rows with reasons)"""
+    parts = [_validate_chunk(chunk, worksheet_name) for chunk in _import_chunks(upload) if not chunk.empty]
+    if not parts: return pd.DataFrame(columns=IMPORT_RULES[worksheet_name]["columns"]), pd.DataFrame()
+    return pd.concat([a for a, _ in parts], ignore_index=True), pd.concat([r for _, r in parts], ignore_index=True)
+
+# ------------------------------------------------------------------
+# 6.9 STREAMING EXPORT (CSV / EXCEL / PARQUET)
+# ------------------------------------------------------------------
+EXPORT_CHUNK = 5000
+EXPORT_FORMATS = {
+    "CSV": ("csv", "text/csv"),
+    "Excel": ("xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "Parquet": ("parquet", "application/vnd.apache.parquet"),
+}
+
+def _is_whole(values):
+    values = values.dropna()
+    return bool((values == values.round()).all())
+
+def _export_frame(chunk, integral=()):
+    """Sheet-shaped values: dates as YYYY-MM-DD, numbers as numbers, everything else as text; integral columns as Int64"""
+    out = chunk.drop(columns=HELPER_COLS + ROW_META, errors="ignore").copy()
+    for c in out.columns:
+        if pd.api.types.is_datetime64_any_dtype(out[c]): out[c] = out[c].dt.strftime("%Y-%m-%d").fillna("")
+        elif not pd.api.types.is_numeric_dtype(out[c]) or pd.api.types.is_bool_dtype(out[c]): out[c] = out[c].map(_cell_value).astype(str)
+        else:
+            values = pd.to_numeric(out[c]).astype(float)
+            out[c] = values.astype("Int64") if c in integral and _is_whole(values) else values
+    return out
+
+def export_file(chunks, fmt):
+    """Writes chunks one at a time into a spooled file (memory up to 8 MB, then disk); returns its bytes.
+    Column types are decided on the first chunk so every chunk writes the same way."""
+    out, columns, writer, integral = tempfile.SpooledTemporaryFile(max_size=8 << 20), None, None, ()
+    for chunk in chunks:
+        if columns is None and fmt != "Parquet":  # Parquet keeps numbers as float: its schema is fixed by the first chunk
+            integral = {c for c in chunk.columns if pd.api.types.is_numeric_dtype(chunk[c]) and not pd.api.types.is_bool_dtype(chunk[c])
+                        and _is_whole(pd.to_numeric(chunk[c]))}
+        chunk = _export_frame(chunk, integral)
+        if columns is None: columns = list(chunk.columns)
+        chunk = chunk.reindex(columns=columns)
+        if fmt == "CSV":
+            # %.15g prints 100 for 100.0, so a later chunk with fractions in an integral column still matches
+            out.write(chunk.to_csv(index=False, header=writer is None, float_format="%.15g").encode("utf-8"))
+            writer = True
+        elif fmt == "Parquet":
+            import pyarrow as pa, pyarrow.parquet as pq
+            table = pa.Table.from_pandas(chunk, schema=writer.schema if writer else None, preserve_index=False)
+            if writer is None: writer = pq.ParquetWriter(out, table.schema)
+            writer.write_table(table)
+        else:
+            if writer is None:
+                from openpyxl import Workbook
+                book = Workbook(write_only=True)
+                writer = book.create_sheet("Export")
+                writer.append(columns)
+            for row in chunk.itertuples(index=False): writer.append([None if pd.isna(v) else v for v in row])
+    if fmt == "Parquet":
+        if writer is not None: writer.close()
+        else:
+            import pyarrow as pa, pyarrow.parquet as pq
+            pq.write_table(pa.table({}), out)
+    elif fmt == "Excel":
+        if writer is None:
+            from openpyxl import Workbook
+            book = Workbook(write_only=True)
+            book.create_sheet("Export")
+        book.save(out)
+    out.seek(0)
+    return out.read()  # st.download_button takes bytes, not a spooled file
+
+def export_formats():
+    """Formats whose writer is installed; Excel needs openpyxl"""
+    import importlib.util
+    return [f for f in EXPORT_FORMATS if f != "Excel" or importlib.util.find_spec("openpyxl")]
+
+# ------------------------------------------------------------------
+# 6.10 ARCHIVE (HOT SHEETS, MONTHLY COLD PARTITIONS)
+# ------------------------------------------------------------------
+CARRY_MARK = "Carry Forward"
+ARCHIVE_RULES = {
+    "Production": {"date": "Date", "closed": "Complete"},
+    "Packing": {"date": "Order Date", "closed": "Complete"},
+    "Store": {"date": "Date Of Entry", "carry": "Recvd From"},
+    "Order": {"date": "Date", "carry": "Remarks"},
+}
+
+def archive_partitions(worksheet_name):
+    prefix = worksheet_name + ARCHIVE_SEP
+    return derived(worksheet_name, "partitions", lambda: sorted(n for n in storage().worksheets() if n.startswith(prefix)))
+
+def load_archive(worksheet_name):
+    """Every archived row of a worksheet; read only when a view asks for history"""
+    parts = [_fetch_sheet(name, sheet_version(name)) for name in archive_partitions(worksheet_name)]
+    parts = [p for p in parts if p is not None and not p.empty]
+    return typed(pd.concat(parts, ignore_index=True), worksheet_name) if parts else pd.DataFrame()
+
+def with_history(worksheet_name, hot):
+    """Hot rows plus the archive for all-time views. Carry-forward rows go, since the archive holds the rows they
+    summarize; a row found twice (an archive run that was retried) counts once."""
+    archive = load_archive(worksheet_name)
+    if archive.empty: return hot
+    rows = pd.concat([archive, hot.drop(columns=HELPER_COLS, errors="ignore")], ignore_index=True)
+    rows = rows[~(rows["_row_id"].duplicated(keep="last") & (rows["_row_id"] != ""))]
+    mark = ARCHIVE_RULES[worksheet_name].get("carry")
+    if mark: rows = rows[rows[mark].astype(object) != CARRY_MARK]
+    return typed(rows.reset_index(drop=True), worksheet_name)
+
+def carry_forward_rows(worksheet_name, moved, cutoff):
+    """One row per non-zero balance of the archived ledger rows, dated on the cutoff so it stays hot"""
+    day = str(cutoff)
+    if worksheet_name == "Store":
+        flows = _stock_flows(moved)
+        net = flows["Inward"] - flows["Outward"]
+        return pd.DataFrame([{"Date Of Entry": day, "Recvd From": CARRY_MARK, "Type": flows.at[item, "Type"], "Item Name": item, "Qty": abs(n),
+                              "Transaction Type": "Inward" if n > 0 else "Outward"} for item, n in net.items() if n])
+    flows = _order_flows(moved)
+    net = flows["Order Received"] - flows["Dispatch"]
+    return pd.DataFrame([{"Date": day, "Transaction Type": "Order Received" if n > 0 else "Dispatch", "Party Name": party, "Item Name": item,
+                          "Qty": abs(n), "Remarks": CARRY_MARK} for (party, item), n in net.items() if n])
+
+def archive_closed(worksheet_name, cutoff):
+    """Moves rows dated before cutoff (on task sheets, only Complete ones) into monthly partitions, then removes them
+    from the hot sheet, where ledgers get carry-forward rows instead. Returns (rows moved, conflicting rows)."""
+    rule = ARCHIVE_RULES[worksheet_name]
+    invalidate_sheet(worksheet_name)
+    data = _fetch_sheet(worksheet_name, sheet_version(worksheet_name))
+    if data is None or data.empty or rule["date"] not in data.columns: return 0, []
+    old = data[rule["date"]].notna() & (data[rule["date"]] < pd.Timestamp(cutoff))
+    if "closed" in rule: old &= data["Status"].astype(object) == rule["closed"]
+    moved = data[old]
+    if moved.empty: return 0, []
+    # Partitions first: if the hot-sheet step then fails, rows exist twice (deduplicated by id), never zero times
+    for month, rows in moved.groupby(moved[rule["date"]].dt.strftime("%Y-%m")):
+        storage().append(f"{worksheet_name}{ARCHIVE_SEP}{month}", rows)
+        invalidate_sheet(f"{worksheet_name}{ARCHIVE_SEP}{month}")
+    carry = carry_forward_rows(worksheet_name, moved, cutoff) if "carry" in rule else None
+    conflicts, _ = storage().write_rows(worksheet_name, {"deleted": list(moved.index), "base": change_base(data, moved.index), "inserted": carry})
+    invalidate_sheet(worksheet_name)
+    return (0 if conflicts else len(moved)), conflicts
+
+def archive_cutoff(keep_months, today=None):
+    """First day of the oldest month kept hot"""
+    today = today or date.today()
+    y, m = divmod(today.year * 12 + today.month - 1 - (keep_months - 1), 12)
+    return date(y, m + 1, 1)
+
 # ------------------------------------------------------------------
 # 7. VISUALIZATION & TABLE HELPERS
 # ------------------------------------------------------------------
+@timed
 def create_spline_chart(df, x_col, y_col, color_col=None):
     """Creates a Modern Spline Area Chart"""
     fig = go.Figure()
     colors = ['#5D87FF', '#49BEFF', '#FFB624', '#FF4B4B']
     
     if color_col:
-        unique_groups = df[color_col].unique()
-        for i, group in enumerate(unique_groups):
-            group_df = df[df[color_col] == group]
+        for i, (group, group_df) in enumerate(df.groupby(color_col, sort=False)):
             fig.add_trace(go.Scatter(
                 x=group_df[x_col], y=group_df[y_col], mode='lines+markers', name=group,
                 line=dict(width=3, shape='spline', color=colors[i % len(colors)]),
@@ -400,6 +1761,7 @@ def create_spline_chart(df, x_col, y_col, color_col=None):
     )
     return fig
 
+@timed
 def create_donut_chart(df, values, names):
     """Creates a Modern Donut Chart"""
     fig = px.pie(df, values=values, names=names, hole=0.7)
@@ -412,6 +1774,21 @@ def create_donut_chart(df, values, names):
     )
     return fig
 
+@st.cache_data(max_entries=64, show_spinner=False)
+def _ecom_figure_json(version, kind, metric, start, end):
+    rollup = ecom_rollup()
+    if kind == "trend":
+        series = daily_series(rollup, metric, start, end)
+        return None if series.empty else create_spline_chart(series, "Date", metric, "Channel Name").to_json()
+    totals = channel_totals(rollup, metric, start, end)
+    return None if totals.empty else create_donut_chart(totals, metric, "Channel Name").to_json()
+
+@timed
+def ecom_figure(kind, metric, start, end):
+    """Ecommerce "trend" or "share" figure for a date range, built once per sheet version and shared by all sessions"""
+    fig = _ecom_figure_json(sheet_version("Ecommerce"), kind, metric, start, end)
+    return json.loads(fig) if fig else None
+
 def color_status(val):
     if not isinstance(val, str): return ''
     val = val.lower()
@@ -420,8 +1797,52 @@ def color_status(val):
     elif 'ship' in val or 'dispatch' in val: return 'background-color: #EBF3FE; color: #5D87FF; font-weight: 600; padding: 4px 10px; border-radius: 20px;'
     return ''
 
-def render_styled_table(df, key_prefix, editable=False, decimal_format=None):
-    if df.empty:
+# ------------------------------------------------------------------
+# 7.1 PAGED TABLE SOURCES
+# ------------------------------------------------------------------
+class FrameSource:
+    """Pages over a DataFrame that is already in memory; rows of a named worksheet search through its index"""
+    def __init__(self, df, worksheet_name=None):
+        self.df, self.worksheet_name = df, worksheet_name
+
+    def fetch_page(self, search=None, sort=None, offset=0, limit=10):
+        df = self.df
+        if search: df = df[search_mask(df, search, worksheet_name=self.worksheet_name)]
+        if sort: df = df.sort_values(by=sort[0], ascending=sort[1], kind="stable")
+        return df.iloc[offset:offset + limit], len(df)
+
+    def iter_chunks(self, size=EXPORT_CHUNK):
+        for start in range(0, len(self.df), size): yield self.df.iloc[start:start + size]
+
+class TableSource:
+    """Pages straight out of the storage engine: one indexed query per page instead of a pass over the sheet"""
+    def __init__(self, worksheet_name, date_col=None, bounds=None, search=None, search_cols=None):
+        self.worksheet_name, self.date_col, self.bounds = worksheet_name, date_col, bounds
+        self.search, self.search_cols, self.engine = search, search_cols, storage()
+
+    def fetch_page(self, search=None, sort=None, offset=0, limit=10):
+        searches = [(self.search, self.search_cols), (search, None)]
+        page, total = self.engine.read_page(self.worksheet_name, self.date_col, self.bounds, searches, sort, offset, limit)
+        return typed(page, self.worksheet_name), total
+
+    def iter_chunks(self, size=EXPORT_CHUNK):
+        for chunk in self.engine.read_chunks(self.worksheet_name, self.date_col, self.bounds, [(self.search, self.search_cols)], size):
+            yield typed(chunk, self.worksheet_name)
+
+def page_source(worksheet_name, frame, **query):
+    """Engine-side paging where the storage engine supports it, else paging over the already-filtered frame"""
+    if hasattr(storage(), "read_page") and write_queue().pending_rows(worksheet_name).empty: return TableSource(worksheet_name, **query)
+    return FrameSource(frame, worksheet_name)
+
+def _set_state(key, value):
+    st.session_state[key] = value
+
+SMART_FORMAT = "smart"  # decimal_format like smart_format: whole numbers bare, others to one decimal
+
+@timed
+def render_styled_table(df, key_prefix, editable=False, decimal_format=None, worksheet_name=None):
+    source = df if hasattr(df, "fetch_page") else FrameSource(df, worksheet_name)
+    if source.fetch_page(limit=0)[1] == 0:
         st.info("No data available.")
         return None
 
@@ -430,27 +1851,26 @@ def render_styled_table(df, key_prefix, editable=False, decimal_format=None):
     with c_search: 
         search_query = st.text_input("Search", placeholder="Search...", key=f"search_{key_prefix}", label_visibility="collapsed")
 
-    df_filtered = df.copy()
-    if search_query:
-        mask = df_filtered.astype(str).apply(lambda x: x.str.contains(search_query, case=False, na=False)).any(axis=1)
-        df_filtered = df_filtered[mask]
-        if f"page_{key_prefix}" in st.session_state: st.session_state[f"page_{key_prefix}"] = 0
+    if f"page_{key_prefix}" not in st.session_state: st.session_state[f"page_{key_prefix}"] = 0
+    if st.session_state.get(f"query_{key_prefix}", "") != search_query:
+        st.session_state[f"query_{key_prefix}"] = search_query
+        st.session_state[f"page_{key_prefix}"] = 0
 
-    if df_filtered.empty:
+    ITEMS_PER_PAGE = 10
+    current_page = st.session_state[f"page_{key_prefix}"]
+    df_page, total_rows = source.fetch_page(search_query, None, current_page * ITEMS_PER_PAGE, ITEMS_PER_PAGE)
+    if total_rows == 0:
         st.warning("No matching records found.")
         return None
 
-    ITEMS_PER_PAGE = 10
-    total_rows = len(df_filtered)
     total_pages = max(1, math.ceil(total_rows / ITEMS_PER_PAGE))
-    
-    if f"page_{key_prefix}" not in st.session_state: st.session_state[f"page_{key_prefix}"] = 0
-    if st.session_state[f"page_{key_prefix}"] >= total_pages: st.session_state[f"page_{key_prefix}"] = max(0, total_pages - 1)
-        
-    current_page = st.session_state[f"page_{key_prefix}"]
+    if current_page >= total_pages:
+        current_page = st.session_state[f"page_{key_prefix}"] = total_pages - 1
+        df_page, total_rows = source.fetch_page(search_query, None, current_page * ITEMS_PER_PAGE, ITEMS_PER_PAGE)
     start_idx = current_page * ITEMS_PER_PAGE
     end_idx = start_idx + ITEMS_PER_PAGE
-    df_page = df_filtered.iloc[start_idx:end_idx]
+    # Edited pages keep the row id (hidden) so the diff can find each row again
+    df_page = df_page.drop(columns=["_rev"] if editable else ROW_META, errors="ignore")
 
     st_config = {}
     status_col = next((c for c in df_page.columns if "Status" in c), None)
@@ -459,38 +1879,72 @@ def render_styled_table(df, key_prefix, editable=False, decimal_format=None):
     
     if decimal_format:
         num_cols = df_page.select_dtypes(include=['float', 'int']).columns
-        for nc in num_cols: st_config[nc] = st.column_config.NumberColumn(nc, format=decimal_format)
+        for nc in num_cols:
+            fmt = decimal_format
+            if fmt == SMART_FORMAT: fmt = "%d" if (df_page[nc].dropna() % 1 == 0).all() else "%.1f"
+            st_config[nc] = st.column_config.NumberColumn(nc, format=fmt)
 
     result = None
     if not editable:
         styled_df = df_page.style.map(color_status, subset=[status_col] if status_col else [])
         st.dataframe(styled_df, use_container_width=True, column_config=st_config, hide_index=True)
     else:
+        # A categorical column would limit the editor to the values already present
+        df_page = df_page.astype({c: object for c in df_page.select_dtypes("category").columns})
         if status_col: st_config[status_col] = st.column_config.SelectboxColumn("Status", options=["Pending", "Complete", "Next Day", "Shipped", "Confirmed"], required=True, width="medium")
-        result = st.data_editor(df_page, use_container_width=True, column_config=st_config, num_rows="fixed", key=f"editor_{key_prefix}_{current_page}", hide_index=True, disabled=["_original_idx"])
+        st_config["_row_id"] = None
+        result = st.data_editor(df_page, use_container_width=True, column_config=st_config, num_rows="fixed", key=f"editor_{key_prefix}_{current_page}", hide_index=True)
 
     st.markdown("---")
     c_info, c_prev, c_page, c_next = st.columns([6, 1, 2, 1])
     with c_info: st.caption(f"Showing {start_idx + 1} to {min(end_idx, total_rows)} of {total_rows} entries")
     with c_prev:
-        if st.button("◀", key=f"prev_{key_prefix}", disabled=(current_page == 0)):
-            st.session_state[f"page_{key_prefix}"] -= 1
-            st.rerun()
+        st.button("◀", key=f"prev_{key_prefix}", disabled=(current_page == 0), on_click=_set_state, args=(f"page_{key_prefix}", current_page - 1))
     with c_page: st.markdown(f"<div style='text-align:center; padding-top:5px; font-weight:500; color:#5A6A85;'>Page {current_page + 1} of {total_pages}</div>", unsafe_allow_html=True)
     with c_next:
-        if st.button("▶", key=f"next_{key_prefix}", disabled=(current_page >= total_pages - 1)):
-            st.session_state[f"page_{key_prefix}"] += 1
-            st.rerun()
+        st.button("▶", key=f"next_{key_prefix}", disabled=(current_page >= total_pages - 1), on_click=_set_state, args=(f"page_{key_prefix}", current_page + 1))
 
     st.markdown("""<script>var buttons = window.parent.document.querySelectorAll('button[kind="secondary"]'); buttons.forEach(btn => { if(btn.innerText === "◀" || btn.innerText === "▶") { btn.classList.add("pagination-btn"); } });</script>""", unsafe_allow_html=True)
     return result
 
+# Fragments: paging, searching and cell edits rerun only the table, on the data of the last full run
+@perf_fragment
+def show_table(df, key_prefix, decimal_format=None, worksheet_name=None):
+    render_styled_table(df, key_prefix, decimal_format=decimal_format, worksheet_name=worksheet_name)
+
+@perf_fragment
+def edit_table(data, df, key_prefix, worksheet_name, save_label, save_key=None, decimal_format=None):
+    edited = render_styled_table(df, key_prefix, editable=True, decimal_format=decimal_format, worksheet_name=worksheet_name)
+    if edited is not None:
+        changes = diff_changes(data, edited)
+        if has_changes(changes):
+            if st.button(save_label, key=save_key): save_smart_update(data, edited, worksheet_name, changes)
+
+def render_export(source, file_name, key, label="Export"):
+    """Download buttons for a table or report; the file is produced chunk by chunk only when one is clicked"""
+    source = source if hasattr(source, "iter_chunks") else FrameSource(source)
+    formats = export_formats()
+    cols = st.columns([2] + [1] * len(formats))
+    with cols[0]: st.caption(f"⬇️ {label}")
+    for col, fmt in zip(cols[1:], formats):
+        ext, mime = EXPORT_FORMATS[fmt]
+        with col:
+            st.download_button(fmt, data=lambda fmt=fmt: export_file(source.iter_chunks(), fmt), file_name=f"{file_name}_{date.today()}.{ext}",
+                               mime=mime, key=f"export_{key}_{ext}", on_click="ignore", use_container_width=True)
+
 # ------------------------------------------------------------------
 # 8. COMPONENT LOGIC (UNIQUE KEYS FIX)
 # ------------------------------------------------------------------
+CARDS_PER_PAGE = 12
+
+@perf_fragment
+@timed
 def render_task_cards(df_display, date_col, role_name, data, worksheet_name, key_suffix=""):
+    """Draws a window of cards; paging through a section reruns only that section"""
+    shown_key = f"cards_{worksheet_name}{key_suffix}"
+    limit = st.session_state.get(shown_key, CARDS_PER_PAGE)
     cols = st.columns(4)
-    for i, (index, row) in enumerate(df_display.iterrows()):
+    for i, (index, row) in enumerate(df_display.iloc[:limit].iterrows()):
         col = cols[i % 4]
         with col:
             prio = smart_format(row.get('Priority') if worksheet_name == "Production" else row.get('Order Priority')) or 999
@@ -499,7 +1953,7 @@ def render_task_cards(df_display, date_col, role_name, data, worksheet_name, key
             with st.container(border=True):
                 c_head, c_del = st.columns([5, 1])
                 with c_head:
-                    st.caption(f"{emoji_prio} Priority {prio} | {row.get(date_col, '-')}")
+                    st.caption(f"{emoji_prio} Priority {prio} | {_cell_value(row.get(date_col)) or '-'}")
                 # NO DELETE BUTTON ON CARDS
 
                 if worksheet_name == "Packing":
@@ -527,12 +1981,31 @@ def render_task_cards(df_display, date_col, role_name, data, worksheet_name, key
 
                 btn_label = "✏️ Edit" if st.session_state["role"] == "Admin" else "✅ Update"
                 # UNIQUE KEY FIX
-                if st.button(btn_label, key=f"btn_{worksheet_name}_{index}{key_suffix}", use_container_width=True):
-                    st.session_state["edit_idx"] = index
+                key = row_key(row, index)
+                if st.button(btn_label, key=f"btn_{worksheet_name}_{key}{key_suffix}", use_container_width=True):
+                    st.session_state["edit_row"] = key
+                    try: st.session_state["edit_fresh"] = storage().read_row(worksheet_name, key) if isinstance(key, str) else None
+                    except Exception: st.session_state["edit_fresh"] = None
+                    st.session_state["nav_target"] = worksheet_name
                     st.rerun()
 
-def render_edit_form(edit_idx, data, worksheet_name, date_col):
-    if edit_idx in data.index:
+    hidden = len(df_display) - limit
+    if hidden > 0 or limit > CARDS_PER_PAGE:
+        c_more, c_less = st.columns([3, 1])
+        with c_more:
+            # Callbacks update the window before the fragment reruns, so no extra rerun is needed
+            if hidden > 0: st.button(f"⬇️ Show {min(hidden, CARDS_PER_PAGE)} more ({hidden} hidden)", key=f"more_{shown_key}", use_container_width=True, on_click=_set_state, args=(shown_key, limit + CARDS_PER_PAGE))
+        with c_less:
+            if limit > CARDS_PER_PAGE: st.button("⬆️ Show less", key=f"less_{shown_key}", use_container_width=True, on_click=_set_state, args=(shown_key, CARDS_PER_PAGE))
+
+@perf_fragment
+def render_edit_form(edit_key, data, worksheet_name, date_col):
+    edit_idx, fresh = row_index(data, edit_key), st.session_state.get("edit_fresh")
+    if edit_idx is not None and fresh and fresh.get("_row_id") == edit_key:
+        # Start from the row as it is now, read on its own when the form opened
+        data = pd.concat([data.drop(index=edit_idx), typed(pd.DataFrame([fresh], index=[edit_idx]), worksheet_name)])
+    if edit_idx is None: st.info("ℹ️ This entry is no longer in the sheet.")
+    else:
         row_data = data.loc[edit_idx]
         with st.container(border=True):
             st.markdown(f"### ✏️ Editing: {row_data.get('Item Name', 'Task')}")
@@ -575,7 +2048,6 @@ def render_edit_form(edit_idx, data, worksheet_name, date_col):
                             updated_row.at[edit_idx, "Box"] = new_box
                             updated_row.at[edit_idx, "Logo"] = new_logo
                             updated_row.at[edit_idx, "Bottom Print"] = new_bot
-                        updated_row["_original_idx"] = edit_idx
                         save_smart_update(data, updated_row, worksheet_name)
             else:
                 with st.form(f"user_{worksheet_name}_update"):
@@ -586,12 +2058,12 @@ def render_edit_form(edit_idx, data, worksheet_name, date_col):
                         updated_row = pd.DataFrame([row_data])
                         updated_row.at[edit_idx, "Ready Qty"] = new_ready
                         updated_row.at[edit_idx, "Status"] = new_status
-                        updated_row["_original_idx"] = edit_idx
                         save_smart_update(data, updated_row, worksheet_name)
-            if st.button("❌ Close Edit"):
-                st.session_state["edit_idx"] = None
-                st.rerun()
+    if st.button("❌ Close Edit"):
+        st.session_state["edit_row"] = None
+        st.rerun()
 
+@perf_fragment
 def render_add_task_form(data, worksheet_name):
     st.divider()
     with st.expander(f"➕ Assign New {worksheet_name} Task", expanded=False):
@@ -633,6 +2105,226 @@ def render_add_task_form(data, worksheet_name):
                         save_new_row(data, new_task, worksheet_name)
         inject_enter_key_navigation()
 
+@perf_fragment
+def render_order_form(data):
+    with st.expander("➕ Add New Order / Dispatch", expanded=True):
+        with st.form("order_entry_form"):
+            c1, c2, c3 = st.columns(3)
+            with c1: 
+                date_val = st.date_input("Date", value=date.today())
+                trans_type = st.selectbox("Transaction Type", ["Order Received", "Dispatch"])
+            with c2:
+                party = st.text_input("Party Name")
+                qty = st.number_input("Quantity", min_value=1.0, step=0.01)
+            with c3:
+                item = st.text_input("Item Name")
+                rem = st.text_input("Remarks")
+            if st.form_submit_button("✅ Submit"):
+                if not party or not item: st.warning("Party Name and Item Name are required")
+                else:
+                    new_order = pd.DataFrame([{"Date": str(date_val), "Transaction Type": trans_type, "Party Name": party, "Item Name": item, "Qty": qty, "Remarks": rem}])
+                    save_new_row(data, new_order, "Order")
+            inject_enter_key_navigation()
+
+@perf_fragment
+def render_store_form(data):
+    with st.expander("➕ Update Stock (Add New Entry)", expanded=True):
+        with st.form("store_form"):
+            c1, c2, c3 = st.columns(3)
+            with c1: date_ent = st.date_input("Date Of Entry", value=date.today())
+            with c2: trans_type = st.selectbox("Transaction Type", ["Inward", "Outward"])
+            with c3: qty = st.number_input("Quantity", min_value=1.0, step=0.01)
+            c4, c5, c6 = st.columns(3)
+            with c4: item_name = st.text_input("Item Name")
+            with c5: uom = st.selectbox("UOM", ["Pcs", "Boxes", "Kg", "Ltr", "Set", "Packet"])
+            with c6: i_type = st.selectbox("Type", ["Inner Box", "Outer Box", "Washer", "String", "Cap", "Bubble", "Bottle", "Other"])
+            c7, c8, c9 = st.columns(3)
+            with c7: recvd_from = st.text_input("Recvd From / Sent To")
+            with c8: vendor_brand = st.text_input("Vendor Name (Brand)")
+            with c9: invoice_no = st.text_input("Invoice No. (Inward Only)")
+
+            if st.form_submit_button("Submit Transaction"):
+                if not item_name: st.warning("⚠️ Item Name is required!")
+                else:
+                    new_entry = pd.DataFrame([{"Date Of Entry": str(date_ent), "Recvd From": recvd_from, "Vendor Name(Brand)": vendor_brand, "Type": i_type, "Item Name": item_name, "Qty": qty, "UOM": uom, "Transaction Type": trans_type, "Invoice No.": invoice_no}])
+                    save_new_row(data, new_entry, "Store")
+        inject_enter_key_navigation()
+
+@perf_fragment
+def render_bulk_import(data, worksheet_name):
+    """Upload, check and append a whole file: one queued batch, one aggregate update"""
+    with st.expander(f"📥 Bulk Import {worksheet_name} (CSV / Excel)"):
+        rules, n = IMPORT_RULES[worksheet_name], st.session_state.get(f"import_n_{worksheet_name}", 0)
+        st.caption(f"Columns: {', '.join(rules['columns'])} · Required: {', '.join(rules['required'])}")
+        upload = st.file_uploader("File", type=["csv", "xlsx"], key=f"import_{worksheet_name}_{n}", label_visibility="collapsed")
+        if upload is None: return
+        cached = st.session_state.get(f"import_check_{worksheet_name}")
+        if cached is None or cached[0] != upload.file_id:
+            try: cached = (upload.file_id, *validate_import(upload, worksheet_name))
+            except ImportError: return st.error("Excel import needs the openpyxl package; upload a CSV instead.")
+            except Exception as e: return st.error(f"Could not read file: {e}")
+            st.session_state[f"import_check_{worksheet_name}"] = cached
+        _, accepted, rejected = cached
+
+        c1, c2 = st.columns(2)
+        with c1: st.metric("Rows Accepted", len(accepted))
+        with c2: st.metric("Rows Rejected", len(rejected))
+        if not rejected.empty:
+            st.markdown("##### ⚠️ Rejected Rows")
+            st.dataframe(rejected.head(200), use_container_width=True, hide_index=True)
+        if not accepted.empty:
+            st.dataframe(accepted.head(10), use_container_width=True, hide_index=True)
+            if st.button(f"✅ Import {len(accepted)} Rows", key=f"import_go_{worksheet_name}", type="primary"):
+                st.session_state[f"import_n_{worksheet_name}"] = n + 1  # Fresh uploader, so the file cannot be imported twice
+                st.session_state.pop(f"import_check_{worksheet_name}", None)
+                save_new_row(data, accepted, worksheet_name, f"✅ Imported {len(accepted)} rows")
+
+@perf_fragment
+def render_ecom_form(data):
+    with st.expander("➕ Add New Ecommerce Entry"):
+        with st.form("eco_form"):
+            c1, c2 = st.columns(2)
+            with c1:
+                date_val = st.date_input("Date")
+                channel = st.selectbox("Channel Name", ["Amazon", "Flipkart", "Meesho", "Ajio", "JioMart", "Myntra", "Aquench.in"])
+                orders = st.number_input("Today's Order", min_value=0)
+            with c2:
+                dispatch = st.number_input("Today's Dispatch", min_value=0)
+                ret = st.number_input("Return", min_value=0)
+            if st.form_submit_button("Add Record"):
+                new_row = pd.DataFrame([{"Date": str(date_val), "Channel Name": channel, "Today's Order": orders, "Today's Dispatch": dispatch, "Return": ret}])
+                save_new_row(data, new_row, "Ecommerce")
+
+            inject_enter_key_navigation()
+
+@perf_fragment
+def render_ecom_trends(data):
+    with st.container(border=True):
+        st.markdown("### 📈 Visual Trends")
+        if not data.empty:
+            today = date.today()
+            default_start = today - timedelta(days=10)
+            c_range, _ = st.columns([1, 2])
+            with c_range: date_range = st.date_input("Chart Date Range", value=(default_start, today), key="viz_range")
+
+            if isinstance(date_range, tuple) and len(date_range) == 2:
+                start_d, end_d = date_range
+                fig_line = ecom_figure("trend", "Today's Order", start_d, end_d)
+
+                g_col, p_col = st.columns([2, 1])
+                with g_col:
+                    if fig_line: st.plotly_chart(fig_line, use_container_width=True)
+                    else: st.info("No data for charts")
+                with p_col:
+                    if fig_line: st.plotly_chart(ecom_figure("share", "Today's Order", start_d, end_d), use_container_width=True)
+
+@perf_fragment
+def render_ecom_overview(data):
+    """Period selector, KPIs and the period's log; changing the period reruns only this block"""
+    df_curr = pd.DataFrame()
+    unique_channels = ["All Channels"]
+    if "Channel Name" in data.columns:
+        channels_list = sorted(data["Channel Name"].dropna().astype(str).unique().tolist())
+        unique_channels.extend(channels_list)
+
+    c_ch, c_date = st.columns(2)
+    with c_ch: selected_channel = st.selectbox("Select Channel", unique_channels, index=0)
+    with c_date: selected_period = st.selectbox("Compare Period", ["Today", "Yesterday", "Last 7 Days", "Last 30 Days", "This Month", "All Time"], index=0)
+
+    if not data.empty:
+        df_calc = data
+        if selected_channel != "All Channels": df_calc = df_calc[df_calc["Channel Name"] == selected_channel]
+
+        today = date.today()
+        if selected_period == "Today":
+            curr_start, curr_end = today, today
+            prev_start, prev_end = today - timedelta(days=1), today - timedelta(days=1)
+        elif selected_period == "Yesterday":
+            curr_start, curr_end = today - timedelta(days=1), today - timedelta(days=1)
+            prev_start, prev_end = today - timedelta(days=2), today - timedelta(days=2)
+        elif selected_period == "Last 7 Days":
+            curr_start, curr_end = today - timedelta(days=6), today
+            prev_start, prev_end = today - timedelta(days=13), today - timedelta(days=7)
+        elif selected_period == "Last 15 Days":
+            curr_start, curr_end = today - timedelta(days=14), today
+            prev_start, prev_end = today - timedelta(days=29), today - timedelta(days=15)
+        elif selected_period == "Last 30 Days":
+            curr_start, curr_end = today - timedelta(days=29), today
+            prev_start, prev_end = today - timedelta(days=59), today - timedelta(days=30)
+        elif selected_period == "This Month":
+            curr_start, curr_end = today.replace(day=1), today
+            prev_month_end = curr_start - timedelta(days=1)
+            prev_month_start = prev_month_end.replace(day=1)
+            prev_start, prev_end = prev_month_start, prev_month_start + (curr_end - curr_start)
+        else:
+            curr_start, curr_end = date.min, date.max
+            prev_start, prev_end = date.min, date.min
+
+        df_curr = df_calc[in_date_range(df_calc["Date"], curr_start, curr_end)]
+        rollup = ecom_rollup()
+
+        def sum_cols(start, end):
+            o, d, r = period_totals(rollup, start, end, None if selected_channel == "All Channels" else selected_channel)
+            return int(o), int(d), int(r)
+
+        c_ord, c_dis, c_ret = sum_cols(curr_start, curr_end)
+        p_ord, p_dis, p_ret = sum_cols(prev_start, prev_end)
+
+        with st.container(border=True):
+            k1, k2, k3 = st.columns(3)
+            def get_delta(curr, prev):
+                if selected_period == "All Time": return None
+                diff = curr - prev
+                if prev == 0: return f"{diff}"
+                pct = round((diff / prev) * 100, 1)
+                return f"{diff} ({pct}%)"
+
+            with k1: st.metric("Total Orders", c_ord, delta=get_delta(c_ord, p_ord))
+            with k2: st.metric("Total Dispatched", c_dis, delta=get_delta(c_dis, p_dis))
+            with k3: st.metric("Total Returns", c_ret, delta=get_delta(c_ret, p_ret), delta_color="inverse")
+            render_export(channel_report(rollup, curr_start, curr_end), "ecommerce_by_channel", "eco_channels", f"{selected_period} by channel")
+
+    st.divider()
+
+    render_ecom_trends(data)
+
+    st.divider()
+
+    with st.container(border=True):
+        st.write("### 📋 Detailed Logs")
+        if df_curr.empty:
+            display_df = pd.DataFrame(columns=data.columns) if not data.empty else pd.DataFrame()
+        else:
+            display_df = df_curr
+
+        is_editable = (st.session_state["role"] == "Ecommerce")
+        if is_editable:
+            edit_table(data, display_df, "eco_log", "Ecommerce", "💾 Save Table Changes")
+            render_ecom_form(data)
+        else:
+            st.info("ℹ️ Read-Only View (Admin Access)")
+            show_table(display_df, "eco_read", worksheet_name="Ecommerce")
+        render_export(display_df, "ecommerce_log", "eco_log", "Logs shown above")
+
+def render_perf_panel():
+    st.markdown("##### ⏱️ Performance")
+    state, last = _perf_state(), st.session_state.get("perf_last")
+    if last:
+        where = f"{last['module']} · {last['fragment']}" if last.get("fragment") else last["module"]
+        st.caption(f"Previous rerun: {where} · {last['ms']:.0f} ms · {len(last['spans'])} spans")
+        spans = pd.DataFrame(last["spans"], columns=["name", "worksheet", "ms", "bytes"])
+        show_table(spans.rename(columns={"name": "Span", "worksheet": "Worksheet", "bytes": "Bytes"}), "perf_spans")
+        calls = spans.dropna(subset=["worksheet"])
+        if not calls.empty:
+            st.write("API calls per worksheet")
+            per_sheet = calls.groupby("worksheet").agg(Calls=("name", "size"), ms=("ms", "sum"), KB=("bytes", lambda b: b.sum() / 1024))
+            show_table(per_sheet.round(1).reset_index().rename(columns={"worksheet": "Worksheet"}), "perf_calls")
+    history = list(state["history"])
+    st.write(f"History ({len(history)} reruns, all sessions)")
+    show_table(perf_percentiles(history), "perf_history")
+    state["log"] = st.checkbox("Append reruns to a JSON-lines log", value=state["log"], key="perf_log",
+                               help=f"Written to {STORAGE.get('perf_log', 'amavik_perf.jsonl')} on the server")
+
 # ------------------------------------------------------------------
 # 9. MAIN LOGIC: MANAGE TAB
 # ------------------------------------------------------------------
@@ -644,14 +2336,10 @@ def manage_tab(tab_name, worksheet_name):
         st.subheader("📊 Amavik ERP Dashboard")
         
         try:
-            eco_data = conn.read(spreadsheet=SHEET_URL, worksheet="Ecommerce", ttl=0)
-            if not eco_data.empty:
-                eco_data["Date"] = pd.to_datetime(eco_data["Date"], errors='coerce').dt.date
-                today = date.today()
-                last_7 = eco_data[(eco_data["Date"] >= (today - timedelta(days=7))) & (eco_data["Date"] <= today)]
-                t_orders = last_7["Today's Order"].sum()
-                t_dispatch = last_7["Today's Dispatch"].sum()
-                t_returns = last_7["Return"].sum()
+            today = date.today()
+            fig_line = ecom_figure("trend", "Today's Order", today - timedelta(days=7), today)
+            if fig_line:
+                t_orders, t_dispatch, t_returns = period_totals(ecom_rollup(), today - timedelta(days=7), today)
                 with st.container(border=True):
                     k1, k2, k3 = st.columns(3)
                     k1.metric("📦 7-Day Orders", int(t_orders))
@@ -659,22 +2347,16 @@ def manage_tab(tab_name, worksheet_name):
                     k3.metric("↩️ 7-Day Returns", int(t_returns))
                 st.markdown("#### 📈 Weekly Trends")
                 c1, c2 = st.columns([2, 1])
-                with c1:
-                    fig_line = create_spline_chart(last_7, "Date", "Today's Order", "Channel Name")
-                    st.plotly_chart(fig_line, use_container_width=True)
-                with c2:
-                    channel_dist = last_7.groupby("Channel Name")["Today's Order"].sum().reset_index()
-                    fig_pie = create_donut_chart(channel_dist, "Today's Order", "Channel Name")
-                    st.plotly_chart(fig_pie, use_container_width=True)
+                with c1: st.plotly_chart(fig_line, use_container_width=True)
+                with c2: st.plotly_chart(ecom_figure("share", "Today's Order", today - timedelta(days=7), today), use_container_width=True)
         except Exception as e: st.error("Could not load Ecommerce data.")
 
         st.divider()
 
         st.markdown("#### 🏭 Production Queue")
         try:
-            prod_data = conn.read(spreadsheet=SHEET_URL, worksheet="Production", ttl=0)
+            prod_data = load_sheet("Production")
             if not prod_data.empty:
-                prod_data["Status"] = prod_data["Status"].fillna("Pending")
                 pending_prod = prod_data[prod_data["Status"] != "Complete"]
                 if not pending_prod.empty:
                     # PASSING KEY_SUFFIX TO FIX DUPLICATE ERROR
@@ -686,25 +2368,20 @@ def manage_tab(tab_name, worksheet_name):
 
         st.markdown("#### 📦 Store Inventory")
         try:
-            store_data = conn.read(spreadsheet=SHEET_URL, worksheet="Store", ttl=0)
+            store_data = load_sheet("Store")
             if not store_data.empty:
-                store_data["Qty"] = pd.to_numeric(store_data["Qty"], errors='coerce').fillna(0)
-                stock_sum = store_data.groupby("Item Name").apply(lambda x: pd.Series({
-                    "Type": x["Type"].iloc[0] if not x["Type"].empty else "", 
-                    "Balance": x[x["Transaction Type"] == "Inward"]["Qty"].sum() - x[x["Transaction Type"] == "Outward"]["Qty"].sum()
-                })).reset_index()
-                render_styled_table(stock_summary=stock_sum, key_prefix="dash_store", decimal_format="%.1f")
+                stock_sum = stock_ledger(store_data)[["Item Name", "Type", "Balance"]]
+                show_table(stock_sum, "dash_store", decimal_format="%.1f")
         except: st.info("Store data unavailable.")
         return
 
     # FOR OTHER TABS
-    df_curr, df_display = pd.DataFrame(), pd.DataFrame()
+    df_display = pd.DataFrame()
     try:
-        data = conn.read(spreadsheet=SHEET_URL, worksheet=worksheet_name, ttl=0)
+        data = load_sheet(worksheet_name)
         if data is None or data.empty: data = pd.DataFrame()
     except: data = pd.DataFrame()
 
-    if not data.empty: data['_original_idx'] = data.index
 
     # ===============================================================
     # A. ORDER TAB
@@ -721,36 +2398,16 @@ def manage_tab(tab_name, worksheet_name):
         tab_log, tab_summ = st.tabs(["Order", "Summary"])
         
         with tab_log:
-            with st.expander("➕ Add New Order / Dispatch", expanded=True):
-                with st.form("order_entry_form"):
-                    c1, c2, c3 = st.columns(3)
-                    with c1: 
-                        date_val = st.date_input("Date", value=date.today())
-                        trans_type = st.selectbox("Transaction Type", ["Order Received", "Dispatch"])
-                    with c2:
-                        party = st.text_input("Party Name")
-                        qty = st.number_input("Quantity", min_value=1.0, step=0.01)
-                    with c3:
-                        item = st.text_input("Item Name")
-                        rem = st.text_input("Remarks")
-                    if st.form_submit_button("✅ Submit"):
-                        if not party or not item: st.warning("Party Name and Item Name are required")
-                        else:
-                            new_order = pd.DataFrame([{"Date": str(date_val), "Transaction Type": trans_type, "Party Name": party, "Item Name": item, "Qty": qty, "Remarks": rem}])
-                            save_new_row(data, new_order, worksheet_name)
-                    inject_enter_key_navigation()
-
-            if not data.empty:
-                for col in data.select_dtypes(include=['float', 'int']).columns:
-                     data[col] = data[col].apply(smart_format)
-                if "Date" in data.columns: data["Date"] = pd.to_datetime(data["Date"], errors='coerce')
-                
-                edited = render_styled_table(data, "order", editable=True)
-                if edited is not None:
-                    clean_view = data.drop(columns=["_original_idx"], errors='ignore')
-                    clean_edited = edited.drop(columns=["_original_idx"], errors='ignore')
-                    if not clean_view.equals(clean_edited):
-                        if st.button("💾 Save Log Changes", key="save_ord_log"): save_smart_update(data, edited, worksheet_name)
+            render_order_form(data)
+            render_bulk_import(data, "Order")
+
+            if st.checkbox("Include archive", key="order_history"):
+                history = with_history(worksheet_name, data)
+                show_table(history, "order_history", decimal_format=SMART_FORMAT)
+                render_export(history, "order_log_all", "order_history", "Order log (all time)")
+            elif not data.empty:
+                edit_table(data, data, "order", worksheet_name, "💾 Save Log Changes", "save_ord_log", decimal_format=SMART_FORMAT)
+                render_export(data, "order_log", "order_log", "Order log")
             else: st.info("No records found.")
 
         with tab_summ:
@@ -761,27 +2418,20 @@ def manage_tab(tab_name, worksheet_name):
                 search_q = st.text_input("🔍 Search Filter", placeholder="Filter...", label_visibility="collapsed")
 
             if not data.empty:
-                df_sum = data.copy()
-                if search_q:
-                    mask = (df_sum['Item Name'].astype(str).str.contains(search_q, case=False, na=False) | df_sum['Party Name'].astype(str).str.contains(search_q, case=False, na=False))
-                    df_sum = df_sum[mask]
-
-                if not df_sum.empty:
-                    base_pivot = df_sum.pivot_table(index=['Party Name', 'Item Name'], columns='Transaction Type', values='Qty', aggfunc='sum', fill_value=0).reset_index()
-                    if "Order Received" not in base_pivot.columns: base_pivot["Order Received"] = 0
-                    if "Dispatch" not in base_pivot.columns: base_pivot["Dispatch"] = 0
-                    base_pivot["Pending Balance"] = base_pivot["Order Received"] - base_pivot["Dispatch"]
-                    
-                    for c in ["Order Received", "Dispatch", "Pending Balance"]: 
-                        base_pivot[c] = base_pivot[c].apply(smart_format)
+                base_pivot = order_balances(data)
+                if search_q: base_pivot = base_pivot[search_mask(base_pivot, search_q, BALANCE_KEYS)]
+
+                if not base_pivot.empty:
+                    base_pivot = base_pivot.round(1)
 
                     if view_mode == "Matrix View":
                         matrix = base_pivot.pivot_table(index="Item Name", columns="Party Name", values="Pending Balance", aggfunc="sum", fill_value=0, margins=True, margins_name="Total")
                         st.dataframe(matrix.style.highlight_between(left=1, right=1000000, color="#ffcdd2"), use_container_width=True)
                     elif view_mode == "Party-wise Summary":
-                        render_styled_table(base_pivot.sort_values(by="Party Name"), "summ_party")
+                        show_table(base_pivot, "summ_party")
                     else:
-                        render_styled_table(base_pivot.sort_values(by="Item Name"), "summ_item")
+                        show_table(base_pivot.sort_values(by="Item Name", kind="stable"), "summ_item")
+                    render_export(base_pivot, "order_pending_balance", "order_pending", "Pending balance by party")
                 else: st.warning("No data matches your search.")
             else: st.info("No Order data available.")
         return 
@@ -794,11 +2444,10 @@ def manage_tab(tab_name, worksheet_name):
         with c_head: st.subheader(f"📦 {worksheet_name} Dashboard")
         with c_btn:
             if st.button("🔄", key=f"ref_{worksheet_name}"):
-                st.cache_data.clear()
+                invalidate_sheet(worksheet_name)
                 st.rerun()
 
         if "Status" not in data.columns: data["Status"] = "Pending"
-        data["Status"] = data["Status"].fillna("Pending").replace("", "Pending")
         
         if worksheet_name == "Production":
             date_col, prio_col = "Date", "Priority"
@@ -809,15 +2458,12 @@ def manage_tab(tab_name, worksheet_name):
             for c in ["Order Date", "Order Priority", "Qty", "Party Name", "Item Name", "Ready Qty"]:
                 if c not in data.columns: data[c] = ""
         
-        if date_col in data.columns: data["_dt_obj"] = pd.to_datetime(data[date_col], errors='coerce').dt.date
+        if pd.api.types.is_datetime64_any_dtype(data[date_col]): data["_dt_obj"] = data[date_col].dt.date
         else: data["_dt_obj"] = date.today()
         data[prio_col] = pd.to_numeric(data[prio_col], errors='coerce').fillna(999)
-        qty_key = "Quantity" if worksheet_name == "Production" else "Qty"
-        if qty_key in data.columns: data[qty_key] = data[qty_key].apply(smart_format)
-        if "Ready Qty" in data.columns: data["Ready Qty"] = data["Ready Qty"].apply(smart_format)
 
-        if st.session_state["edit_idx"] is not None:
-            render_edit_form(st.session_state["edit_idx"], data, worksheet_name, date_col)
+        if st.session_state["edit_row"] is not None:
+            render_edit_form(st.session_state["edit_row"], data, worksheet_name, date_col)
             return
 
         if st.session_state["role"] == "Admin":
@@ -854,11 +2500,16 @@ def manage_tab(tab_name, worksheet_name):
 
         with t_upcoming:
             upcoming_data = data[(data["_dt_obj"] > date.today()) & (data["Status"] != "Complete")].copy()
-            render_styled_table(upcoming_data.drop(columns=["_original_idx", "_dt_obj"], errors='ignore'), f"upcoming_{worksheet_name}")
+            show_table(upcoming_data.drop(columns=["_dt_obj"], errors='ignore'), f"upcoming_{worksheet_name}", decimal_format=SMART_FORMAT, worksheet_name=worksheet_name)
+            render_export(upcoming_data, f"{worksheet_name.lower()}_upcoming", f"upcoming_{worksheet_name}", "Upcoming tasks")
 
         if t_all:
             with t_all:
-                render_styled_table(data.drop(columns=["_original_idx", "_dt_obj"], errors='ignore'), f"all_{worksheet_name}")
+                if st.checkbox("Include archive", key=f"history_{worksheet_name}"):
+                    all_source = FrameSource(with_history(worksheet_name, data))
+                else: all_source = page_source(worksheet_name, data.drop(columns=["_dt_obj"], errors='ignore'))
+                show_table(all_source, f"all_{worksheet_name}", decimal_format=SMART_FORMAT)
+                render_export(all_source, f"{worksheet_name.lower()}_all", f"all_{worksheet_name}", "All tasks")
         return
 
     # ===============================================================
@@ -876,80 +2527,50 @@ def manage_tab(tab_name, worksheet_name):
             with c1: d_filter = st.selectbox("📅 Date Filter", ["All", "Today", "Yesterday", "Prev 7 Days", "This Month"], key="st_date")
             with c2: search_query = st.text_input("🔍 Universal Search (Item, Party, Type, Inv No.)", placeholder="Type at least 3 digits to search...")
 
-            filtered_df = filter_by_date(data, d_filter, date_col_name="Date Of Entry")
-            if search_query and len(search_query) >= 3:
-                mask = (filtered_df['Item Name'].astype(str).str.contains(search_query, case=False, na=False) | filtered_df['Recvd From'].astype(str).str.contains(search_query, case=False, na=False) | filtered_df['Type'].astype(str).str.contains(search_query, case=False, na=False) | filtered_df['Transaction Type'].astype(str).str.contains(search_query, case=False, na=False) | filtered_df['Invoice No.'].astype(str).str.contains(search_query, case=False, na=False))
-                filtered_df = filtered_df[mask]
+            search_cols = ["Item Name", "Recvd From", "Type", "Transaction Type", "Invoice No."]
+            if not (search_query and len(search_query) >= 3): search_query = None
+            # Archived rows are read only on request; the hot sheet alone already balances through its carry-forward rows
+            history = st.checkbox("Include archive", key="store_history")
+            rows = with_history(worksheet_name, data) if history else data
+            filtered_df = filter_by_date(rows, d_filter, date_col_name="Date Of Entry")
+            if search_query: filtered_df = filtered_df[search_mask(filtered_df, search_query, search_cols, None if history else worksheet_name)]
 
             if not filtered_df.empty:
                 with st.expander("📊 Live Stock Analysis (Based on Current Search)", expanded=True):
-                    df_calc = filtered_df.copy()
-                    df_calc["Qty"] = pd.to_numeric(df_calc["Qty"], errors="coerce").fillna(0).astype(float)
-                    stock_summary = df_calc.groupby("Item Name").apply(lambda x: pd.Series({
-                        "Type": x["Type"].iloc[0] if not x["Type"].empty else "", 
-                        "Inward": x[x["Transaction Type"] == "Inward"]["Qty"].sum(), 
-                        "Outward": x[x["Transaction Type"] == "Outward"]["Qty"].sum()
-                    })).reset_index()
-                    stock_summary["Balance"] = stock_summary["Inward"] - stock_summary["Outward"]
-                    render_styled_table(stock_summary.round(1), "stock", decimal_format="%.1f")
+                    if d_filter == "All" and not search_query and not history: stock_summary = stock_ledger(data)
+                    else: stock_summary = compute_stock_balance(filtered_df)
+                    show_table(stock_summary.round(1), "stock", decimal_format="%.1f")
+                    render_export(stock_summary.round(1), "stock_balance", "stock", "Stock balance")
 
             if st.session_state["role"] == "Store":
                 st.write("### 📋 Transaction Log")
-                if filtered_df.empty: df_display = pd.DataFrame(columns=data.columns).drop(columns=["_original_idx"], errors="ignore")
-                else: df_display = filtered_df.copy()
-                
-                if "Qty" in df_display.columns: df_display["Qty"] = pd.to_numeric(df_display["Qty"], errors='coerce').fillna(0).astype(float).round(1)
-                if "Date Of Entry" in df_display.columns: df_display["Date Of Entry"] = pd.to_datetime(df_display["Date Of Entry"], errors='coerce')
-                
-                edited_df = render_styled_table(df_display, "store_log", editable=True, decimal_format="%.1f")
-                if edited_df is not None:
-                    clean_view = df_display.drop(columns=["_original_idx"], errors='ignore')
-                    clean_edited = edited_df.drop(columns=["_original_idx"], errors='ignore')
-                    if not clean_view.equals(clean_edited):
-                        if st.button("💾 Save Changes", key="save_store"): save_smart_update(data, edited_df, worksheet_name)
+                if filtered_df.empty: df_display = pd.DataFrame(columns=data.columns)
+                else: df_display = filtered_df
+                if history:
+                    log_source = FrameSource(df_display)
+                    show_table(log_source, "store_history", decimal_format="%.1f")
+                else:
+                    log_source = page_source(worksheet_name, df_display, date_col="Date Of Entry", bounds=date_bounds(d_filter), search=search_query, search_cols=search_cols)
+                    edit_table(data, log_source, "store_log", worksheet_name, "💾 Save Changes", "save_store", decimal_format="%.1f")
+                render_export(log_source, "store_ledger", "store_log", f"Ledger ({d_filter})")
 
                 st.divider()
-                with st.expander("➕ Update Stock (Add New Entry)", expanded=True):
-                    with st.form("store_form"):
-                        c1, c2, c3 = st.columns(3)
-                        with c1: date_ent = st.date_input("Date Of Entry", value=date.today())
-                        with c2: trans_type = st.selectbox("Transaction Type", ["Inward", "Outward"])
-                        with c3: qty = st.number_input("Quantity", min_value=1.0, step=0.01)
-                        c4, c5, c6 = st.columns(3)
-                        with c4: item_name = st.text_input("Item Name")
-                        with c5: uom = st.selectbox("UOM", ["Pcs", "Boxes", "Kg", "Ltr", "Set", "Packet"])
-                        with c6: i_type = st.selectbox("Type", ["Inner Box", "Outer Box", "Washer", "String", "Cap", "Bubble", "Bottle", "Other"])
-                        c7, c8, c9 = st.columns(3)
-                        with c7: recvd_from = st.text_input("Recvd From / Sent To")
-                        with c8: vendor_brand = st.text_input("Vendor Name (Brand)")
-                        with c9: invoice_no = st.text_input("Invoice No. (Inward Only)")
-
-                        if st.form_submit_button("Submit Transaction"):
-                            if not item_name: st.warning("⚠️ Item Name is required!")
-                            else:
-                                new_entry = pd.DataFrame([{"Date Of Entry": str(date_ent), "Recvd From": recvd_from, "Vendor Name(Brand)": vendor_brand, "Type": i_type, "Item Name": item_name, "Qty": qty, "UOM": uom, "Transaction Type": trans_type, "Invoice No.": invoice_no}])
-                                save_new_row(data, new_entry, worksheet_name)
-                    inject_enter_key_navigation()
+                render_store_form(data)
+                render_bulk_import(data, "Store")
             else: st.info("🚫 Restricted")
         
         with tab_plan:
             st.info("ℹ️ Packing Planning")
-            try: packing_data = conn.read(spreadsheet=SHEET_URL, worksheet="Packing", ttl=0)
-            except: packing_data = pd.DataFrame()
-            if not packing_data.empty:
-                d_col = "Order Date" if "Order Date" in packing_data.columns else "Date"
-                packing_data["dt_obj"] = pd.to_datetime(packing_data[d_col], errors='coerce').dt.date
-                mask_plan = (packing_data["dt_obj"] >= (date.today() - timedelta(days=7))) & (packing_data["dt_obj"] <= (date.today() + timedelta(days=5)))
-                plan_df = packing_data[mask_plan].copy()
+            try: plan_df = load_range("Packing", "Order Date", date.today() - timedelta(days=7), date.today() + timedelta(days=5))
+            except: plan_df = pd.DataFrame()
+            if not plan_df.empty:
+                d_col = "Order Date"
                 cols = []
                 for c in [d_col, "Party Name", "Item Name", "Qty"]:
                     if c in plan_df.columns: cols.append(c)
                 cols_to_show = list(dict.fromkeys(cols))
-                final_plan = plan_df[cols_to_show].copy()
-                if "Qty" in final_plan.columns: 
-                    final_plan["Qty"] = pd.to_numeric(final_plan["Qty"], errors='coerce').fillna(0).astype(float).round(1)
-                
-                render_styled_table(final_plan, "plan", decimal_format="%.1f")
+                final_plan = plan_df[cols_to_show]
+                show_table(final_plan, "plan", decimal_format="%.1f")
             else: st.info("Empty")
         return
 
@@ -958,143 +2579,7 @@ def manage_tab(tab_name, worksheet_name):
     # ===============================================================
     if worksheet_name == "Ecommerce":
         st.subheader("📊 Performance Overview")
-        df_curr = pd.DataFrame()
-        unique_channels = ["All Channels"]
-        if "Channel Name" in data.columns:
-            channels_list = sorted(data["Channel Name"].astype(str).unique().tolist())
-            unique_channels.extend(channels_list)
-
-        c_ch, c_date = st.columns(2)
-        with c_ch: selected_channel = st.selectbox("Select Channel", unique_channels, index=0)
-        with c_date: selected_period = st.selectbox("Compare Period", ["Today", "Yesterday", "Last 7 Days", "Last 30 Days", "This Month", "All Time"], index=0)
-
-        if not data.empty:
-            df_calc = data.copy()
-            df_calc["dt"] = pd.to_datetime(df_calc["Date"], errors='coerce').dt.date
-            if selected_channel != "All Channels": df_calc = df_calc[df_calc["Channel Name"] == selected_channel]
-
-            today = date.today()
-            if selected_period == "Today":
-                curr_start, curr_end = today, today
-                prev_start, prev_end = today - timedelta(days=1), today - timedelta(days=1)
-            elif selected_period == "Yesterday":
-                curr_start, curr_end = today - timedelta(days=1), today - timedelta(days=1)
-                prev_start, prev_end = today - timedelta(days=2), today - timedelta(days=2)
-            elif selected_period == "Last 7 Days":
-                curr_start, curr_end = today - timedelta(days=6), today
-                prev_start, prev_end = today - timedelta(days=13), today - timedelta(days=7)
-            elif selected_period == "Last 15 Days":
-                curr_start, curr_end = today - timedelta(days=14), today
-                prev_start, prev_end = today - timedelta(days=29), today - timedelta(days=15)
-            elif selected_period == "Last 30 Days":
-                curr_start, curr_end = today - timedelta(days=29), today
-                prev_start, prev_end = today - timedelta(days=59), today - timedelta(days=30)
-            elif selected_period == "This Month":
-                curr_start, curr_end = today.replace(day=1), today
-                prev_month_end = curr_start - timedelta(days=1)
-                prev_month_start = prev_month_end.replace(day=1)
-                prev_start, prev_end = prev_month_start, prev_month_start + (curr_end - curr_start)
-            else:
-                curr_start, curr_end = date.min, date.max
-                prev_start, prev_end = date.min, date.min
-
-            mask_curr = (df_calc["dt"] >= curr_start) & (df_calc["dt"] <= curr_end)
-            df_curr = df_calc[mask_curr]
-            mask_prev = (df_calc["dt"] >= prev_start) & (df_calc["dt"] <= prev_end)
-            df_prev = df_calc[mask_prev]
-
-            def sum_cols(df):
-                o = pd.to_numeric(df["Today's Order"], errors='coerce').sum()
-                d = pd.to_numeric(df["Today's Dispatch"], errors='coerce').sum()
-                r = pd.to_numeric(df["Return"], errors='coerce').sum()
-                return int(o), int(d), int(r)
-
-            c_ord, c_dis, c_ret = sum_cols(df_curr)
-            p_ord, p_dis, p_ret = sum_cols(df_prev)
-
-            with st.container(border=True):
-                k1, k2, k3 = st.columns(3)
-                def get_delta(curr, prev):
-                    if selected_period == "All Time": return None
-                    diff = curr - prev
-                    if prev == 0: return f"{diff}"
-                    pct = round((diff / prev) * 100, 1)
-                    return f"{diff} ({pct}%)"
-
-                with k1: st.metric("Total Orders", c_ord, delta=get_delta(c_ord, p_ord))
-                with k2: st.metric("Total Dispatched", c_dis, delta=get_delta(c_dis, p_dis))
-                with k3: st.metric("Total Returns", c_ret, delta=get_delta(c_ret, p_ret), delta_color="inverse")
-
-        st.divider()
-
-        with st.container(border=True):
-            st.markdown("### 📈 Visual Trends")
-            if not data.empty:
-                df_viz = data.copy()
-                df_viz["Date"] = pd.to_datetime(df_viz["Date"], errors='coerce')
-                df_viz["Today's Order"] = pd.to_numeric(df_viz["Today's Order"], errors='coerce').fillna(0)
-                today = date.today()
-                default_start = today - timedelta(days=10)
-                c_range, _ = st.columns([1, 2])
-                with c_range: date_range = st.date_input("Chart Date Range", value=(default_start, today), key="viz_range")
-
-                if isinstance(date_range, tuple) and len(date_range) == 2:
-                    start_d, end_d = date_range
-                    mask_viz = (df_viz["Date"].dt.date >= start_d) & (df_viz["Date"].dt.date <= end_d)
-                    df_viz_filtered = df_viz[mask_viz]
-                    
-                    g_col, p_col = st.columns([2, 1])
-                    with g_col:
-                        if not df_viz_filtered.empty:
-                            fig_line = create_spline_chart(df_viz_filtered, "Date", "Today's Order", "Channel Name")
-                            st.plotly_chart(fig_line, use_container_width=True)
-                        else: st.info("No data for charts")
-                    with p_col:
-                        if not df_viz_filtered.empty and "Channel Name" in df_viz_filtered.columns:
-                            channel_dist = df_viz_filtered.groupby("Channel Name")["Today's Order"].sum().reset_index()
-                            fig_pie = create_donut_chart(channel_dist, "Today's Order", "Channel Name")
-                            st.plotly_chart(fig_pie, use_container_width=True)
-
-        st.divider()
-
-        with st.container(border=True):
-            st.write("### 📋 Detailed Logs")
-            if df_curr.empty:
-                display_df = pd.DataFrame(columns=data.columns).drop(columns=["dt"], errors="ignore") if not data.empty else pd.DataFrame()
-            else:
-                display_df = df_curr.drop(columns=["dt"], errors="ignore")
-
-            is_editable = (st.session_state["role"] == "Ecommerce")
-            if is_editable:
-                for c in ["Today's Order", "Today's Dispatch", "Return"]:
-                    if c in display_df.columns:
-                        display_df[c] = pd.to_numeric(display_df[c], errors='coerce').apply(smart_format)
-
-                edited_df = render_styled_table(display_df, "eco_log", editable=True)
-                if edited_df is not None:
-                    clean_view = display_df.drop(columns=["_original_idx"], errors='ignore')
-                    clean_edited = edited_df.drop(columns=["_original_idx"], errors='ignore')
-                    if not clean_view.equals(clean_edited):
-                        if st.button("💾 Save Table Changes"): save_smart_update(data, edited_df, worksheet_name)
-                
-                with st.expander("➕ Add New Ecommerce Entry"):
-                    with st.form("eco_form"):
-                        c1, c2 = st.columns(2)
-                        with c1:
-                            date_val = st.date_input("Date")
-                            channel = st.selectbox("Channel Name", ["Amazon", "Flipkart", "Meesho", "Ajio", "JioMart", "Myntra", "Aquench.in"])
-                            orders = st.number_input("Today's Order", min_value=0)
-                        with c2:
-                            dispatch = st.number_input("Today's Dispatch", min_value=0)
-                            ret = st.number_input("Return", min_value=0)
-                        if st.form_submit_button("Add Record"):
-                            new_row = pd.DataFrame([{"Date": str(date_val), "Channel Name": channel, "Today's Order": orders, "Today's Dispatch": dispatch, "Return": ret}])
-                            save_new_row(data, new_row, worksheet_name)
-                        
-                        inject_enter_key_navigation()
-            else:
-                st.info("ℹ️ Read-Only View (Admin Access)")
-                render_styled_table(display_df.drop(columns=["_original_idx"], errors='ignore'), "eco_read")
+        render_ecom_overview(data)
         return
 
 # ------------------------------------------------------------------
@@ -1103,9 +2588,14 @@ def manage_tab(tab_name, worksheet_name):
 if not st.session_state["logged_in"]:
     login()
 else:
+    if "flash" in st.session_state:
+        msg, icon = st.session_state.pop("flash")
+        st.toast(msg, icon=icon)
+
     with st.sidebar:
         st.write(f"👤 **{st.session_state['user']}**")
         st.caption(f"Role: {st.session_state['role']}")
+        render_sync_status()
         if st.button("Logout", use_container_width=True): logout()
 
     c1, c2 = st.columns([1, 1]) # Tight layout
@@ -1114,21 +2604,62 @@ else:
     with c2:
         st.write("") 
         st.write("") 
-        if st.button("🔄 Refresh Data", key="global_refresh"):
-            st.cache_data.clear()
-            st.rerun()
+        refresh = st.button("🔄 Refresh Data", key="global_refresh")
+    if refresh: invalidate_sheet()
+    if refresh or not st.session_state.get("sheets_loaded"):
+        # Refresh (or a session that skipped the sign-in warm-up) reads every worksheet the user needs at once
+        with st.spinner("Loading data..."):
+            failed = prefetch_sheets(sheets_for(st.session_state["access"]))
+        st.session_state["sheets_loaded"] = True
+        if failed: st.warning(f"⚠️ Could not load: {', '.join(failed)}. Each is retried when its module opens.")
 
     preferred = ["Dashboard", "Order", "Production", "Packing", "Store", "Ecommerce", "Configuration"]
     available_tabs = [t for t in preferred if t in st.session_state["access"]]
     
     if available_tabs:
-        tabs = st.tabs(available_tabs)
-        for tab, title in zip(tabs, available_tabs):
-            with tab:
-                if title == "Configuration":
-                    st.header("⚙️ System Configuration")
-                    st.info("Only Admin can access this area.")
-                else:
-                    manage_tab(title, title)
+        # ROUTER: ONLY THE SELECTED MODULE RUNS ON A RERUN
+        if st.session_state.get("nav_target") in available_tabs:
+            st.session_state["active_module"] = st.session_state.pop("nav_target")
+        if st.session_state.get("active_module") not in available_tabs:
+            st.session_state["active_module"] = available_tabs[0]
+        title = st.radio("Module", available_tabs, horizontal=True, key="active_module", label_visibility="collapsed")
+        st.divider()
+        if title == "Configuration":
+            st.header("⚙️ System Configuration")
+            st.info("Only Admin can access this area.")
+            with st.container(border=True):
+                st.markdown(f"##### 🗄️ Storage Engine: `{storage().name}`")
+                if storage().name == "sqlite":
+                    st.caption(f"Local database: {STORAGE.get('path', 'amavik.db')}")
+                    if st.button("📥 Import Google Sheets into Local Database", key="import_gsheets"):
+                        with st.spinner("Copying worksheets..."):
+                            copy_worksheets(GSheetsStorage(st.connection("gsheets", type=GSheetsConnection)), storage())
+                        st.session_state["flash"] = ("✅ Local database refreshed from Google Sheets", "🗄️")
+                        st.rerun()
+            with st.container(border=True):
+                st.markdown("##### 📦 Archive")
+                keep = st.number_input("Months kept in the working sheets", min_value=1, max_value=24, value=3, step=1, key="archive_keep")
+                cutoff = archive_cutoff(int(keep))
+                st.caption(f"Complete tasks and ledger rows dated before {cutoff} move to monthly archive sheets; "
+                           "Store and Order keep a carry-forward row per open balance.")
+                if st.button("📦 Archive Closed Records", key="archive_run"):
+                    moved, conflicts, failed = 0, [], False
+                    with st.spinner("Archiving..."):
+                        for name in ARCHIVE_RULES:
+                            try: count, clash = archive_closed(name, cutoff)
+                            except Exception as e:
+                                st.error(f"Error archiving {name}: {e}")
+                                failed = True
+                                continue
+                            moved, conflicts = moved + count, conflicts + clash
+                    if conflicts: st.warning(conflict_message(conflicts))
+                    if failed or conflicts: st.info(f"Archived {moved} rows from the other worksheets.")
+                    else:
+                        st.session_state["flash"] = (f"✅ Archived {moved} rows", "📦")
+                        st.rerun()
+            with st.container(border=True): render_perf_panel()
+        else:
+            with span(f"manage_tab {title}"): manage_tab(title, title)
     else:
         st.error("No modules assigned to your role.")
+    perf_end(st.session_state.get("active_module"))